@@ -0,0 +1,66 @@
+import numpy as np
+from sample_store import SampleStore
+
+# question length and number of candidates of every sample
+def sample_sizes(samples):
+    if isinstance(samples, SampleStore):
+        return samples.question_lengths(), samples.candidate_lengths()
+    question_lengths = np.fromiter((len(sample[2]) for sample in samples),
+                                   dtype=np.int64, count=len(samples))
+    candidate_lengths = np.fromiter((len(sample[1]) for sample in samples),
+                                    dtype=np.int64, count=len(samples))
+    return question_lengths, candidate_lengths
+
+# cut the ordered sample indexes into batches whose padded question tokens
+# plus candidate relations stay within token_budget. A sample over the budget
+# gets a batch of its own
+def budget_batches(order, question_lengths, candidate_lengths, token_budget):
+    batches = []
+    start = 0
+    max_length = 0
+    num_cands = 0
+    for end, index in enumerate(order):
+        length = max(max_length, question_lengths[index])
+        cands = num_cands + candidate_lengths[index]
+        if end > start and length*(end-start+1) + cands > token_budget:
+            batches.append(order[start:end])
+            start = end
+            length = question_lengths[index]
+            cands = candidate_lengths[index]
+        max_length = length
+        num_cands = cands
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+# the batches of the samples as arrays of sample indexes. By default the
+# samples are cut every batch_size samples in their order, like slicing.
+# bucketed sorts the samples by question length and number of candidates
+# first, so the samples of a batch have similar sizes and little padding.
+# With token_budget the batches are cut by size instead of by batch_size.
+# shuffle breaks the ties of the sort and the order of the batches randomly
+def get_batches(samples, batch_size, bucketed=False, token_budget=None,
+                shuffle=False):
+    order = np.arange(len(samples))
+    if bucketed or token_budget is not None:
+        question_lengths, candidate_lengths = sample_sizes(samples)
+    if bucketed:
+        keys = [candidate_lengths, question_lengths]
+        if shuffle:
+            keys.insert(0, np.random.random(len(samples)))
+        order = np.lexsort(keys)
+    if token_budget is None:
+        batches = [order[i:i+batch_size]
+                   for i in range(0, len(order), batch_size)]
+    else:
+        batches = budget_batches(order, question_lengths, candidate_lengths,
+                                 token_budget)
+    if shuffle:
+        np.random.shuffle(batches)
+    return batches
+
+# the samples of a batch, as a store view or as a list
+def take_samples(samples, indexs):
+    if isinstance(samples, SampleStore):
+        return samples.take(indexs)
+    return [samples[i] for i in indexs]
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+from parallel_io import map_file_chunks
+from config import CONFIG as conf
+
+bert_feature_file = conf['bert_feature_file']
+
+# the float32 feature matrix sits beside the text file, row i is the feature
+# of line i, which is the training sample i
+def feature_store_path(feature_file):
+    return os.path.splitext(feature_file)[0] + '.npy'
+
+def store_is_fresh(feature_file):
+    store_file = feature_store_path(feature_file)
+    return os.path.exists(store_file) and \
+        os.path.getmtime(store_file) >= os.path.getmtime(feature_file)
+
+# each line looks like "[0.1, 0.2, ...]\n"
+def parse_feature_lines(lines):
+    features = [np.fromstring(line[1:-2], dtype=float, sep=',')
+                for line in lines]
+    if len(features) == 0:
+        return None
+    return np.asarray(features).astype(np.float32)
+
+# parse the text features once and write the binary store
+def convert_feature(feature_file):
+    chunks = map_file_chunks(parse_feature_lines, feature_file)
+    features = np.concatenate([chunk for chunk in chunks if chunk is not None])
+    store_file = feature_store_path(feature_file)
+    np.save(store_file + '.tmp.npy', features)
+    os.replace(store_file + '.tmp.npy', store_file)
+
+# open the features as a memory-mapped float32 matrix, converting the text
+# file on first use. A .npy file is opened directly
+def read_embedding(file_name=bert_feature_file):
+    if not file_name.endswith('.npy'):
+        if not store_is_fresh(file_name):
+            convert_feature(file_name)
+        file_name = feature_store_path(file_name)
+    return np.load(file_name, mmap_mode='r')
+
+if __name__ == '__main__':
+    convert_feature(bert_feature_file)
@@ -3,6 +3,7 @@ from sklearn.decomposition import PCA
 #from matplotlib import pyplot
 from data import gen_data
 from config import CONFIG as conf
+from bert_feature import read_embedding
 
 bert_feature_file = conf['bert_feature_file']
 
@@ -32,14 +33,6 @@ def read_relation_name(file_name):
             ret_names.append(line[:-2])
     return ret_names
 
-def read_embedding(file_name):
-    ret_np = []
-    with open(file_name) as file_in:
-        for line in file_in:
-            ret_np.append(np.fromstring(line[1:-2], dtype=float, sep=','))
-    #print(ret_np)
-    return np.asarray(ret_np)
-
 def compute_rel_embed(training_data, relation_names=None):
     que_rel_embeddings = read_embedding(bert_feature_file)
     rel_indexs = {}
@@ -58,9 +51,9 @@ def compute_rel_embed(training_data, relation_names=None):
         '''
     rel_embed = {}
     for rel in rel_indexs:
-        que_rel_embeds = [que_rel_embeddings[i] for i in rel_indexs[rel]]
+        que_rel_embeds = que_rel_embeddings[rel_indexs[rel]]
         #rel_embed[rel] = np.max(que_rel_embeds, 0)
-        rel_embed[rel] = np.mean(que_rel_embeds, 0)
+        rel_embed[rel] = np.mean(que_rel_embeds, 0, dtype=np.float64)
     rel_ids = rel_embed.keys()
     if relation_names is not None:
         rel_names = [relation_names[rel_indexs[i][0]].split('|||')[1]
@@ -1,3 +1,4 @@
+import os
 import torch
 CONFIG= {
     'learning_rate': 0.001,
@@ -17,11 +18,32 @@ CONFIG= {
     'lr_revers_model': 0.0001,
     'epoch_revers_model': 10,
     'model_path': 'model.pt',
+    'scripted_model_path': 'model.ts.pt',
     'device': torch.device('cuda:0' if torch.cuda.is_available() else 'cpu'),
     'bert_feature_file': './data/bert_feature/bert_feature.txt',
     'relation_file': './data/relation.2M.list',
     'training_file': './data/train.replace_ne.withpool',
     'test_file': './data/test.replace_ne.withpool',
     'valid_file': './data/valid.replace_ne.withpool',
-    'glove_file': './data/glove.6B.300d.txt'
+    'glove_file': './data/glove.6B.300d.txt',
+    'cache_dir': './data/cache',
+    'segment_cache_file': './data/cache/wordninja_segments.pkl',
+    'num_workers': os.cpu_count(),
+    'bucket_batches': False,
+    'batch_token_budget': None,
+    'shuffle_buckets': False,
+    'prefetch_batches': 2,
+    'prefetch_workers': 1,
+    'eval_rel_index': True,
+    'eval_workers': 1,
+    'rel_index_batch_size': 1000,
+    'retrieval_block_size': 65536,
+    'retrieval_top_k': 10,
+    'ivf_num_lists': 1024,
+    'ivf_num_probes': 16,
+    'ivf_train_size': 100000,
+    'rel_catalog_file': './data/cache/rel_catalog.bin',
+    'predict_max_batch_size': 64,
+    'predict_max_latency': 0.002,
+    'que_embed_cache_size': 0
 }
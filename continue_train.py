@@ -10,10 +10,14 @@ from sklearn.cluster import KMeans
 from sklearn import preprocessing  # to normalise existing X
 
 from data import gen_data
+from sample_store import SampleStore
+from batch_sampler import get_batches, take_samples
+from embed_cache import que_embed_cache
 from model import SimilarityModel
 from utils import process_testing_samples, process_samples, ranking_sequence,\
-    get_grad_params, copy_param_data, copy_grad_data
-from evaluate import evaluate_model, compute_diff_scores
+    get_grad_params, copy_param_data, copy_grad_data, RelationBank,\
+    get_question_rows, pad_candidates, BatchCache
+from evaluate import compute_diff_scores, score_candidates
 from data_partition import cluster_data
 from config import CONFIG as conf
 from train import train, sample_constrains, sample_given_pro, get_nearest_cand,\
@@ -21,6 +25,7 @@ from train import train, sample_constrains, sample_given_pro, get_nearest_cand,\
 from compute_rel_embed import compute_rel_embed
 from reverse_model import update_reverse_model
 from reverse_model import ReverseModel
+from rel_embed_snapshot import save_rel_embed_snapshot
 
 embedding_dim = conf['embedding_dim']
 hidden_dim = conf['hidden_dim']
@@ -40,17 +45,21 @@ num_cands = conf['num_cands']
 num_steps = conf['num_steps']
 num_contrain = conf['num_constrain']
 data_per_constrain = conf['data_per_constrain']
+bucket_batches = conf['bucket_batches']
+batch_token_budget = conf['batch_token_budget']
 
+# split the sample store into one view per cluster
 def split_data(data_set, cluster_labels, num_clusters, shuffle_index):
-    splited_data = [[] for i in range(num_clusters)]
-    for data in data_set:
-        cluster_number = cluster_labels[data[0]]
-        index_number = shuffle_index[cluster_number]
-        splited_data[index_number].append(data)
-    return splited_data
+    relations, relation_pos = np.unique(data_set.relations(),
+                                        return_inverse=True)
+    index_numbers = np.array([shuffle_index[cluster_labels[rel]]
+                              for rel in relations], dtype=np.int64)
+    return data_set.split(index_numbers[relation_pos], num_clusters)
 
 # remove unseen relations from the dataset
 def remove_unseen_relation(dataset, seen_relations):
+    if isinstance(dataset, SampleStore):
+        return dataset.filter_candidates(seen_relations)
     #print(dataset[0])
     cleaned_data = []
     for data in dataset:
@@ -227,45 +236,39 @@ def sample_relations_task(relations_frequences, rel_ques_cand, num_samples):
 def gen_fisher(model, train_data, all_relations):
     num_correct = 0
     #testing_data = testing_data[0:100]
-    softmax_func = nn.LogSoftmax(0)
-    loss_func = nn.NLLLoss()
+    softmax_func = nn.LogSoftmax(1)
+    loss_func = nn.NLLLoss(reduction='sum')
     fisher_batch_size = 1
     batch_epoch = (len(train_data)-1)//fisher_batch_size+1
     fisher = None
     for i in range(batch_epoch):
         model.zero_grad()
-        losses = []
         samples = train_data[i*fisher_batch_size:(i+1)*fisher_batch_size]
-        questions, relations, relation_set_lengths = process_samples(
+        questions, relation_ids, relation_set_lengths = process_samples(
             samples, all_relations, device)
         #print('got data')
         ranked_questions, reverse_question_indexs = \
             ranking_sequence(questions)
-        ranked_relations, reverse_relation_indexs =\
-            ranking_sequence(relations)
+        pad_relations, relation_lengths, reverse_relation_indexs, \
+            relation_rows = all_relations.gather_unique(relation_ids)
         question_lengths = [len(question) for question in ranked_questions]
-        relation_lengths = [len(relation) for relation in ranked_relations]
         #print(ranked_questions)
         pad_questions = torch.nn.utils.rnn.pad_sequence(ranked_questions)
-        pad_relations = torch.nn.utils.rnn.pad_sequence(ranked_relations)
         #print(pad_questions)
         pad_questions = pad_questions.to(device)
-        pad_relations = pad_relations.to(device)
         #print(pad_questions)
 
-        model.init_hidden(device, sum(relation_set_lengths))
+        question_rows = get_question_rows(relation_set_lengths, device)
         all_scores = model(pad_questions, pad_relations, device,
                            reverse_question_indexs, reverse_relation_indexs,
-                           question_lengths, relation_lengths)
+                           question_lengths, relation_lengths,
+                           question_rows=question_rows,
+                           relation_rows=relation_rows)
         all_scores = all_scores.to('cpu')
-        start_index = 0
-        for length in relation_set_lengths:
-            scores = all_scores[start_index:start_index+length]
-            start_index += length
-            #print(scores)
-            losses.append(loss_func(softmax_func(scores).view(1, -1),
-                                    torch.tensor([0])))
-        loss_batch = sum(losses)
+        # the padding is -inf, so it takes no probability mass
+        scores, mask = pad_candidates(all_scores, relation_set_lengths)
+        loss_batch = loss_func(softmax_func(scores),
+                               torch.zeros(len(scores), dtype=torch.long))
         #print(loss_batch)
         loss_batch.backward()
         grad_params = get_grad_params(model)
@@ -310,57 +313,48 @@ def update_rel_embed(model, all_seen_rels, all_relations, rel_embeds):
     if model is not None and len(all_seen_rels) > 0:
         for i in range((len(all_seen_rels)-1)//batch_size+1):
             seen_rels_batch = all_seen_rels[i*batch_size:(i+1)*batch_size]
-            relations = [torch.tensor(all_relations[i],
-                                          dtype=torch.long).to(device)
-                             for i in seen_rels_batch]
-            model.init_hidden(device, len(relations))
-            ranked_relations, reverse_relation_indexs = \
-                ranking_sequence(relations)
-            relation_lengths = [len(relation) for relation in ranked_relations]
-            #print(ranked_relations)
-            pad_relations = torch.nn.utils.rnn.pad_sequence(ranked_relations)
+            pad_relations, relation_lengths, reverse_relation_indexs = \
+                all_relations.gather(seen_rels_batch)
+            #print(pad_relations)
             new_rel_embeds = model.compute_rel_embed(pad_relations, relation_lengths,
                                                  reverse_relation_indexs)
             for i, rel in enumerate(seen_rels_batch):
                 rel_embeds[rel] = new_rel_embeds[i].cpu().numpy()
 
+# write the embeddings of all seen relations as a binary snapshot
 def save_rel_embeds(model, all_seen_rels, all_relations, file_name):
-    rel_embeds = {}
     if model is not None and len(all_seen_rels) > 0:
+        rel_embeds = np.empty((len(all_seen_rels), hidden_dim*2),
+                              dtype=np.float32)
         for i in range((len(all_seen_rels)-1)//batch_size+1):
             seen_rels_batch = all_seen_rels[i*batch_size:(i+1)*batch_size]
-            relations = [torch.tensor(all_relations[i],
-                                          dtype=torch.long).to(device)
-                             for i in seen_rels_batch]
-            model.init_hidden(device, len(relations))
-            ranked_relations, reverse_relation_indexs = \
-                ranking_sequence(relations)
-            relation_lengths = [len(relation) for relation in ranked_relations]
-            #print(ranked_relations)
-            pad_relations = torch.nn.utils.rnn.pad_sequence(ranked_relations)
+            pad_relations, relation_lengths, reverse_relation_indexs = \
+                all_relations.gather(seen_rels_batch)
+            #print(pad_relations)
             new_rel_embeds = model.compute_rel_embed(pad_relations, relation_lengths,
-                                                 reverse_relation_indexs)
-            for i, rel in enumerate(seen_rels_batch):
-                rel_embeds[rel] = new_rel_embeds[i].cpu().numpy()
-        rels = list(rel_embeds.keys())
-        values = rel_embeds.values()
-        with open(file_name, 'w') as writer:
-            writer.write(str(rels)+'\n')
-            for embed in values:
-                to_write = [round(x, 6) for x in embed]
-                writer.write(str(to_write)+'\n')
+                                                 reverse_relation_indexs, None)
+            rel_embeds[i*batch_size:i*batch_size+len(seen_rels_batch)] = \
+                new_rel_embeds.cpu().numpy()
+        save_rel_embed_snapshot(file_name, all_seen_rels, rel_embeds)
 
 def get_que_embed(model, sample_list, all_relations, reverse_model,
                   before_reverse=False):
     ret_que_embeds = []
-    for i in range((len(sample_list)-1)//batch_size+1):
-        samples = sample_list[i*batch_size:(i+1)*batch_size]
+    batches = get_batches(sample_list, batch_size, bucket_batches,
+                          batch_token_budget)
+    for batch in batches:
+        samples = take_samples(sample_list, batch)
+        if que_embed_cache.max_size > 0:
+            que_embeds = que_embed_cache.que_embeds(
+                model, [item[2] for item in samples], device, reverse_model,
+                before_reverse)
+            ret_que_embeds.append(que_embeds.cpu().numpy())
+            continue
         questions = []
         for item in samples:
             this_question = torch.tensor(item[2], dtype=torch.long).to(device)
             questions.append(this_question)
         #print(len(questions))
-        model.init_hidden(device, len(questions))
         ranked_questions, reverse_question_indexs = \
             ranking_sequence(questions)
         question_lengths = [len(question) for question in ranked_questions]
@@ -370,25 +364,21 @@ def get_que_embed(model, sample_list, all_relations, reverse_model,
                                              reverse_question_indexs,
                                              reverse_model, before_reverse)
         ret_que_embeds.append(que_embeds.detach().cpu().numpy())
-    return np.concatenate(ret_que_embeds)
+    # back to the order of sample_list
+    que_embeds = np.concatenate(ret_que_embeds)
+    que_embeds[np.concatenate(batches)] = que_embeds.copy()
+    return que_embeds
 
 def get_rel_embed(model, sample_list, all_relations, reverse_model,
                   before_reverse=False):
     ret_rel_embeds = []
     for i in range((len(sample_list)-1)//batch_size+1):
         samples = sample_list[i*batch_size:(i+1)*batch_size]
-        relations = []
-        for item in samples:
-            this_relation = torch.tensor(all_relations[item[0]],
-                                         dtype=torch.long).to(device)
-            relations.append(this_relation)
-        #print(len(relations))
-        model.init_hidden(device, len(relations))
-        ranked_relations, reverse_relation_indexs = \
-            ranking_sequence(relations)
-        relation_lengths = [len(relation) for relation in ranked_relations]
-        #print(ranked_relations)
-        pad_relations = torch.nn.utils.rnn.pad_sequence(ranked_relations)
+        relation_ids = [item[0] for item in samples]
+        #print(len(relation_ids))
+        pad_relations, relation_lengths, reverse_relation_indexs = \
+            all_relations.gather(relation_ids)
+        #print(pad_relations)
         rel_embeds = model.compute_rel_embed(pad_relations, relation_lengths,
                                              reverse_relation_indexs,
                                              reverse_model, before_reverse)
@@ -562,6 +552,9 @@ def run_sequence(training_data, testing_data, valid_data, all_relations,
                     '''
         #update_rel_embed(current_model, all_seen_rels, all_relations, rel_embeds)
         update_rel_cands(memory_data, all_seen_rels, rel_embeds)
+        # the memory candidates were just resampled, so the batches of this
+        # task are collated into a new cache
+        batch_cache = BatchCache(all_relations, device)
         all_seen_data = []
         for this_memory in memory_data:
             all_seen_data+=this_memory
@@ -580,7 +573,8 @@ def run_sequence(training_data, testing_data, valid_data, all_relations,
                               rel_embeds, rel_ques_cand, rel_acc_diff,
                                         all_seen_rels, update_rel_embed,
                                         reverse_model, memory_que_embed,
-                                        memory_rel_embed)
+                                        memory_rel_embed,
+                                        batch_cache=batch_cache)
         #updata_saved_relations(current_train_data, rel_samples,
         #                       relations_frequences_all, rel_acc_diff, acc_diff)
         #print(len(rel_samples))
@@ -594,7 +588,7 @@ def run_sequence(training_data, testing_data, valid_data, all_relations,
         #updata_full_saved_relations(splited_training_data[i], full_rel_samples)
         #rel_samples = rm_unseen_rels(full_rel_samples, seen_relations)
         #save_rel_embeds(current_model, all_seen_rels, all_relations,
-        #                'model_embed/embed'+str(i)+'.txt')
+        #                'model_embed/embed'+str(i)+'.bin')
         #to_save_data = filter_data(current_train_data, current_model,
         #                           all_relations)
         #enlarge_rel_graph(current_train_data, None,
@@ -648,7 +642,7 @@ def run_sequence(training_data, testing_data, valid_data, all_relations,
                               rel_embeds, rel_ques_cand, rel_acc_diff,
                                         all_seen_rels, update_rel_embed,
                                         reverse_model, memory_que_embed,
-                                        memory_rel_embed, True)
+                                        memory_rel_embed, True, batch_cache)
         if len(memory_data) > 1:
             cur_que_embed = [get_que_embed(current_model, this_memory,
                                            all_relations, reverse_model, True)
@@ -679,15 +673,16 @@ def run_sequence(training_data, testing_data, valid_data, all_relations,
                                                        embed_diff_samples))
                                                        '''
         #print('embed diff', embed_diff_result)
-        results = [evaluate_model(current_model, test_data, batch_size,
-                                  all_relations, device, reverse_model)
+        # the task splits are views on the rows of the testing data, so
+        # its candidates are scored once and every accuracy follows
+        test_scores = score_candidates(current_model, testing_data,
+                                       batch_size, all_relations, device,
+                                       reverse_model)
+        results = [test_scores.accuracy(test_data)
                    for test_data in current_test_data]
         print_list(results)
         sequence_results.append(np.array(results))
-        result_whole_test.append(evaluate_model(current_model,
-                                                testing_data, batch_size,
-                                                all_relations, device,
-                                                reverse_model))
+        result_whole_test.append(test_scores.accuracy(testing_data))
         #break
     print('test set size:', [len(test_set) for test_set in current_test_data])
     #save_embed_diff_result(embed_diff_result)
@@ -714,6 +709,7 @@ if __name__ == '__main__':
     embed_result_file = 'null.txt'
     training_data, testing_data, valid_data, all_relations, vocabulary, \
         embedding=gen_data()
+    all_relations = RelationBank(all_relations, device)
     #bert_rel_features = compute_rel_embed(training_data)
     #print_avg_cand(training_data)
     #print(training_data[0])
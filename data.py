@@ -1,6 +1,11 @@
 import numpy as np
-import wordninja
-import re
+from itertools import chain
+from glove_store import load_glove_store
+from data_cache import cache_key, load_cache, save_cache
+from relation_tokenizer import RelationTokenizer
+from sample_store import SampleStore, RelationTokens, lengths2offsets
+from parallel_io import map_file_chunks
+from relation_names import RelationNames
 from config import CONFIG as conf
 
 relation_file = conf['relation_file']
@@ -16,141 +21,148 @@ random_seed = conf['random_seed']
 def remove_return_sym(str):
     return str.split('\n')[0]
 
+def parse_relation_lines(lines):
+    return [remove_return_sym(line) for line in lines]
+
 # get the relation names from the file
 def read_relations(relation_file):
     relation_list = []
     relation_list.append('/fill/fill/fill')
-    with open(relation_file) as file_in:
-        for line in file_in:
-            relation_list.append(remove_return_sym(line))
+    for names in map_file_chunks(parse_relation_lines, relation_file):
+        relation_list += names
     return relation_list
 
-# extract the glove vocabulary and glove embedding from the file
+# extract the glove vocabulary and glove embedding from the binary store
+# (built from the text file on first use). The vocabulary is the word -> row
+# dict and the embedding is looked up from the memory-mapped matrix
 def read_glove(glove_file):
-    glove_vocabulary = []
-    glove_embedding = {}
-    with open(glove_file) as file_in:
-        for line in file_in:
-            items = line.split()
-            word = items[0]
-            glove_vocabulary.append(word)
-            glove_embedding[word] = np.asarray(items[1:], dtype='float32')
-    return glove_vocabulary, glove_embedding
-
-# read the training/testing/valid sample from file
+    glove_store = load_glove_store(glove_file)
+    return glove_store.word_index, glove_store
+
+# parse the lines of a sample file into the relation ids, the candidates and
+# the question words with their lengths
+def parse_sample_lines(lines):
+    relation_ids = []
+    cand_lengths = []
+    cand_values = []
+    question_lengths = []
+    question_values = []
+    for line in lines:
+        items = line.split('\t')
+        if(len(items[0])>0):
+            relation_ix = int(items[0])
+            #print(items[1].split())
+            if items[1] != 'noNegativeAnswer':
+                candidate_ixs = items[1].split()
+                question = remove_return_sym(items[2]).split()
+                relation_ids.append(relation_ix)
+                cand_lengths.append(len(candidate_ixs))
+                cand_values += candidate_ixs
+                question_lengths.append(len(question))
+                question_values += question
+    return np.array(relation_ids, dtype=np.int32), \
+        np.array(cand_lengths, dtype=np.int64), \
+        np.array(cand_values, dtype=np.int64).astype(np.int32), \
+        np.array(question_lengths, dtype=np.int64), question_values
+
+# read the training/testing/valid sample from file into a SampleStore. The
+# question words are kept as a list of strings until they are mapped to ids
 def read_samples(sample_file):
-    sample_data = []
-    with open(sample_file) as file_in:
-        for line in file_in:
-            items = line.split('\t')
-            if(len(items[0])>0):
-                relation_ix = int(items[0])
-                #print(items[1].split())
-                if items[1] != 'noNegativeAnswer':
-                    candidate_ixs = [int(ix) for ix in items[1].split()]
-                    question = remove_return_sym(items[2]).split()
-                    sample_data.append([relation_ix, candidate_ixs, question])
-    return sample_data
-
-# concat words by using '_'
-def concat_words(words):
-    if len(words) > 0:
-        return_str = words[0]
-        for word in words[1:]:
-            return_str += '_' + word
-        return return_str
-    else:
-        return ''
-
-# split the relation into words together with relation name, eg. birth_place_of
-# will be turned into [birth, place, of, birth_place_of]
-def split_relation_into_words(relation, glove_vocabulary):
-    word_list = []
-    relation_list = []
-    # some relation will have fours parts, where the first part looks like
-    # "base". We only choose the last three parts
-    for word_seq in relation.split("/")[-3:]:
-        new_word_list = []
-        #for word in word_seq.split("_"):
-        for word in re.findall(r"[\w']+", word_seq):
-            #print(word)
-            if word not in glove_vocabulary:
-                new_word_list += wordninja.split(word)
-            else:
-                new_word_list += [word]
-        #print(new_word_list)
-        word_list += new_word_list
-        relation_list.append(concat_words(new_word_list))
-    return word_list+relation_list
+    chunks = map_file_chunks(parse_sample_lines, sample_file)
+    relation_ids, cand_lengths, cand_values, question_lengths = \
+        [np.concatenate([chunk[i] for chunk in chunks]) for i in range(4)]
+    question_values = list(chain.from_iterable(chunk[4] for chunk in chunks))
+    return SampleStore(relation_ids, lengths2offsets(cand_lengths),
+                       cand_values, lengths2offsets(question_lengths),
+                       question_values)
 
 # some words are put together, such computerscience. Need to split these words
-# in the samples, and will split the relation
+# in the samples, and will split the relation into words together with
+# relation name, eg. birth_place_of will be turned into
+# [birth, place, of, birth_place_of]
 def clean_relations(relation_list, glove_vocabulary):
-    cleaned_relations = []
-    for relation in relation_list:
-        cleaned_relations.append(split_relation_into_words(relation, glove_vocabulary))
-    return cleaned_relations
-
-# build the vocabulary and embedding from the relations and questions based on
-# the glove embeddings
-def build_vocabulary_embedding(relation_list, all_samples, glove_embedding,
-                               embedding_size):
-    vocabulary = {}
-    embedding = []
-    index = 0
+    tokenizer = RelationTokenizer(glove_vocabulary, r"[\w']+")
+    return tokenizer.split_relations(relation_list, with_names=True)
+
+# map the tokens of all relations and questions to vocabulary ids in one
+# pass. dict.fromkeys keeps the first occurrence order, relations first, so
+# the vocabulary is the same as building it word by word. Returns the
+# vocabulary, one int32 array holding the ids of all token lists and the
+# offsets of each list in that array
+def build_vocabulary_ids(token_lists):
+    offsets = np.zeros(len(token_lists)+1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, token_lists), dtype=np.int64,
+                          count=len(token_lists)), out=offsets[1:])
+    words = dict.fromkeys(chain.from_iterable(token_lists))
+    vocabulary = dict(zip(words, range(len(words))))
+    token_ids = np.fromiter(map(vocabulary.__getitem__,
+                                chain.from_iterable(token_lists)),
+                            dtype=np.int32, count=offsets[-1])
+    return vocabulary, token_ids, offsets
+
+# build the embedding of the vocabulary based on the glove embeddings
+def build_embedding(vocabulary, glove_embedding, embedding_size):
+    glove_rows = np.fromiter((glove_embedding.word_index.get(word, -1)
+                              for word in vocabulary),
+                             dtype=np.int64, count=len(vocabulary))
+    in_glove = glove_rows >= 0
+    embedding = np.empty((len(vocabulary), embedding_size))
+    embedding[in_glove] = glove_embedding.matrix[glove_rows[in_glove]]
+    # init the word that are not in glove vocabulary randomly, drawing them
+    # in vocabulary order gives the same values as one draw per word
     np.random.seed(100)
-    for relation in relation_list:
-        for word in relation:
-            if word not in vocabulary:
-                vocabulary[word] = index
-                index += 1
-                # init the word that are not in glove vocabulary randomly
-                if word in glove_embedding:
-                    embedding.append(glove_embedding[word])
-                else:
-                    embedding.append(np.random.rand(embedding_size))
-    for sample in all_samples:
-        question = sample[2]
-        for word in question:
-            if word not in vocabulary:
-                vocabulary[word] = index
-                index += 1
-                # init the word that are not in glove vocabulary randomly
-                if word in glove_embedding:
-                    embedding.append(glove_embedding[word])
-                else:
-                    #print(word)
-                    embedding.append(np.random.rand(embedding_size))
-
-    return vocabulary, embedding
-
-# transform the word in the list into the index in the vocabulary
-def words2indexs(word_list, vocabulary):
-    index_list = []
-    for word in word_list:
-        index_list.append(vocabulary[word])
-    return index_list
-
-# transform the words in the relations into index in the vocabulary
-def transform_relations(relation_list, vocabulary):
-    relation_ixs = []
-    for relation in relation_list:
-        relation_ixs.append(words2indexs(relation, vocabulary))
-    return relation_ixs
-
-# transform the words in the questions into index of the vocabulary
-def transform_questions(sample_list, vocabulary):
-    for sample in sample_list:
-        sample[2] = words2indexs(sample[2], vocabulary)
-    return sample_list
-
+    embedding[~in_glove] = np.random.rand(len(vocabulary)-in_glove.sum(),
+                                          embedding_size)
+    return embedding
+
+# build the vocabulary and embedding from the relations and questions, and
+# transform the words of the relations and the questions of the sample stores
+# into index arrays of the vocabulary. The relations are returned as
+# RelationTokens, one flat id array and its offsets
+def build_vocabulary_embedding(relation_list, sample_stores, glove_embedding,
+                               embedding_size):
+    question_lists = [store.question_values for store in sample_stores]
+    vocabulary, token_ids, offsets = \
+        build_vocabulary_ids(relation_list + question_lists)
+    embedding = build_embedding(vocabulary, glove_embedding, embedding_size)
+    relation_ixs = RelationTokens(token_ids[:offsets[len(relation_list)]],
+                                  offsets[:len(relation_list)+1])
+    for i, store in enumerate(sample_stores):
+        list_index = len(relation_list) + i
+        store.question_values = \
+            token_ids[offsets[list_index]:offsets[list_index+1]]
+    return vocabulary, embedding, relation_ixs
+
+# the relation names, read lazily from the file through a line offset index
 def read_origin_relation():
-    relation_list = read_relations(relation_file)
-    return relation_list
+    return RelationNames(relation_file)
+
+# bump when the preprocessing below changes, so old cache entries are ignored
+gen_data_version = 5
 
-# generate the training, valid, test data
+# generate the training, valid, test data. The result is cached on disk under
+# a key built from the content of the input files and the config values used
 #def gen_data(relation_file, training_file, test_file, valid_file, glove_file):
 def gen_data():
+    key = cache_key('gen_data',
+                    [relation_file, training_file, test_file, valid_file,
+                     glove_file],
+                    ['relation_file', 'training_file', 'test_file',
+                     'valid_file', 'glove_file', 'embedding_dim'],
+                    gen_data_version)
+    cached_data = load_cache(key)
+    if cached_data is not None:
+        data, random_state = cached_data
+        # building the vocabulary seeds and draws from the global numpy
+        # generator, restore its state so later sampling is unchanged
+        np.random.set_state(random_state)
+        return data
+    data = build_data()
+    save_cache(key, (data, np.random.get_state()))
+    return data
+
+# read the files and build the training, valid, test data from scratch
+def build_data():
     relation_list = read_relations(relation_file)
     #print(relation_list[1:10])
     glove_vocabulary, glove_embedding = read_glove(glove_file)
@@ -160,23 +172,16 @@ def gen_data():
     #print(training_data[0])
     testing_data = read_samples(test_file)
     valid_data = read_samples(valid_file)
-    all_samples = training_data + testing_data + valid_data
     #print(training_data[0])
     cleaned_relations = clean_relations(relation_list, glove_vocabulary)
     #print(cleaned_relations)
-    vocabulary, embedding = build_vocabulary_embedding(cleaned_relations,
-                                                       all_samples,
-                                                       glove_embedding,
-                                                       embedding_size)
-    #print(embedding)
-    #print(vocabulary)
+    vocabulary, embedding, relation_numbers = \
+        build_vocabulary_embedding(cleaned_relations,
+                                   [training_data, testing_data, valid_data],
+                                   glove_embedding, embedding_size)
     #print(len(vocabulary), len(embedding))
-    relation_numbers = transform_relations(cleaned_relations, vocabulary)
     #print(relation_numbers[0:10])
-    training_data = transform_questions(training_data, vocabulary)
     #print(training_data[0:10])
-    testing_data = transform_questions(testing_data, vocabulary)
-    valid_data = transform_questions(valid_data, vocabulary)
     return training_data, testing_data, valid_data, relation_numbers,\
         vocabulary,embedding
 
@@ -0,0 +1,66 @@
+import os
+import json
+import pickle
+import hashlib
+from config import CONFIG as conf
+
+cache_dir = conf['cache_dir']
+digest_file = 'file_digests.json'
+
+# sha1 of the file content. The digest is remembered together with the size
+# and mtime of the file, so a file is only re-hashed after it has changed
+def file_digest(file_name):
+    file_name = os.path.abspath(file_name)
+    stat = os.stat(file_name)
+    digest_path = os.path.join(cache_dir, digest_file)
+    digests = {}
+    if os.path.exists(digest_path):
+        with open(digest_path) as file_in:
+            digests = json.load(file_in)
+    saved = digests.get(file_name)
+    if saved is not None and saved[0] == stat.st_size and \
+            saved[1] == stat.st_mtime_ns:
+        return saved[2]
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as file_in:
+        for block in iter(lambda: file_in.read(1 << 24), b''):
+            sha1.update(block)
+    digests[file_name] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (digest_path, os.getpid())
+    with open(tmp_path, 'w') as file_out:
+        json.dump(digests, file_out)
+    os.replace(tmp_path, digest_path)
+    return digests[file_name][2]
+
+# build the cache key from the content of the input files and the config
+# values that change the output
+def cache_key(name, file_names, conf_keys, version):
+    sha1 = hashlib.sha1()
+    sha1.update(('%s:%s' % (name, version)).encode('utf8'))
+    for file_name in file_names:
+        sha1.update(file_digest(file_name).encode('utf8'))
+    for key in conf_keys:
+        sha1.update(('%s=%r' % (key, conf[key])).encode('utf8'))
+    return name + '_' + sha1.hexdigest()[:16]
+
+def cache_path(key):
+    return os.path.join(cache_dir, key + '.pkl')
+
+# return the cached object, or None if there is no cache entry for the key
+def load_cache(key):
+    path = cache_path(key)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file_in:
+        return pickle.load(file_in)
+
+def save_cache(key, value):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(key)
+    # several seeds of a sweep may build the same entry at once, so every
+    # process writes its own temporary file before the atomic rename
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as file_out:
+        pickle.dump(value, file_out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
@@ -0,0 +1,99 @@
+import numpy as np
+import torch
+import weakref
+from itertools import count
+from collections import OrderedDict
+from utils import ranking_sequence
+from config import CONFIG as conf
+
+que_embed_cache_size = conf['que_embed_cache_size']
+
+# a serial number per model object. Unlike id() it is never reused by a new
+# model once the old one is freed
+model_serials = weakref.WeakKeyDictionary()
+next_serial = count()
+
+# the identity of a model and of the values of its parameters. Every in place
+# update of a parameter (optimizer steps included) bumps its _version, so the
+# version changes whenever the model does
+def model_version(model):
+    if model is None:
+        return None
+    if model not in model_serials:
+        model_serials[model] = next(next_serial)
+    return (model_serials[model],) + tuple(param._version
+                                           for param in model.parameters())
+
+# a bounded LRU cache of question embeddings in front of
+# SimilarityModel.compute_que_embed. An embedding is keyed by the version of
+# the model, the token ids of the question and the version of the reverse
+# model applied to it (None when it is not applied). Embeddings of a changed
+# model are never hit again and age out of the cache. The cache is off
+# unless que_embed_cache_size is set above 0
+class QuestionEmbedCache(object):
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = que_embed_cache_size
+        self.max_size = max_size
+        self.embeds = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.embeds)
+
+    def clear(self):
+        self.embeds.clear()
+        self.hits = 0
+        self.misses = 0
+
+    # the embeddings of the questions (token id arrays), one row each, in
+    # the order of questions. Only the missing questions are encoded
+    def que_embeds(self, model, questions, device, reverse_model=None,
+                   before_reverse=False):
+        if before_reverse:
+            reverse_model = None
+        version = (model_version(model), model_version(reverse_model))
+        keys = [(version, tuple(np.asarray(question).tolist()))
+                for question in questions]
+        rows = [None]*len(keys)
+        missing = {}
+        for i, key in enumerate(keys):
+            if key in self.embeds:
+                self.embeds.move_to_end(key)
+                rows[i] = self.embeds[key]
+                self.hits += 1
+            elif key in missing:
+                missing[key].append(i)
+                self.hits += 1
+            else:
+                missing[key] = [i]
+                self.misses += 1
+        if len(missing) > 0:
+            new_questions = [torch.tensor(questions[indexs[0]],
+                                          dtype=torch.long).to(device)
+                             for indexs in missing.values()]
+            ranked_questions, reverse_question_indexs = \
+                ranking_sequence(new_questions)
+            question_lengths = [len(question) for question in ranked_questions]
+            pad_questions = torch.nn.utils.rnn.pad_sequence(ranked_questions)
+            new_embeds = model.compute_que_embed(pad_questions,
+                                                 question_lengths,
+                                                 reverse_question_indexs,
+                                                 reverse_model)
+            for (key, indexs), embed in zip(missing.items(), new_embeds):
+                for i in indexs:
+                    rows[i] = embed
+                # a row view would keep the whole batch tensor alive
+                self.insert(key, embed.clone())
+        return torch.stack(rows)
+
+    def insert(self, key, embed):
+        if self.max_size <= 0:
+            return
+        self.embeds[key] = embed
+        if len(self.embeds) > self.max_size:
+            self.embeds.popitem(last=False)
+
+# the cache shared by get_que_embed and evaluate_model
+que_embed_cache = QuestionEmbedCache()
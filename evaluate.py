@@ -1,110 +1,333 @@
+import sys
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from itertools import chain
 
 from data import gen_data
 from model import SimilarityModel
-from utils import process_testing_samples, process_samples, ranking_sequence
+from utils import process_testing_samples, process_samples, ranking_sequence,\
+    RelationBank, get_question_rows, pad_candidates, scripted_scores
+from sample_store import SampleStore, gather_csr
+from batch_sampler import get_batches, take_samples
+from embed_cache import que_embed_cache
+from parallel_io import fork_map
 from config import CONFIG as conf
 
 model_path = conf['model_path']
 batch_size = conf['batch_size']
 device = conf['device']
+bucket_batches = conf['bucket_batches']
+batch_token_budget = conf['batch_token_budget']
+eval_rel_index = conf['eval_rel_index']
+rel_index_batch_size = conf['rel_index_batch_size']
+scripted_model_path = conf['scripted_model_path']
+eval_workers = conf['eval_workers']
 
 def compute_diff_scores(model, samples, batch_size, all_relations, device):
     #testing_data = testing_data[0:100]
     for i in range((len(samples)-1)//batch_size+1):
         samples = samples[i*batch_size:(i+1)*batch_size]
-        questions, relations, relation_set_lengths = \
+        questions, relation_ids, relation_set_lengths = \
             process_samples(samples, all_relations, device)
-        model.init_hidden(device, sum(relation_set_lengths))
         ranked_questions, reverse_question_indexs = \
             ranking_sequence(questions)
-        ranked_relations, reverse_relation_indexs =\
-            ranking_sequence(relations)
+        pad_relations, relation_lengths, reverse_relation_indexs, \
+            relation_rows = all_relations.gather_unique(relation_ids)
+        question_rows = get_question_rows(relation_set_lengths, device)
         question_lengths = [len(question) for question in ranked_questions]
-        relation_lengths = [len(relation) for relation in ranked_relations]
         #print(ranked_questions)
         pad_questions = torch.nn.utils.rnn.pad_sequence(ranked_questions)
-        pad_relations = torch.nn.utils.rnn.pad_sequence(ranked_relations)
         all_scores = model(pad_questions, pad_relations, device,
                            reverse_question_indexs, reverse_relation_indexs,
-                           question_lengths, relation_lengths)
-        start_index = 0
-        diff_scores = []
-        #print('len of relation_set:', len(relation_set_lengths))
-        for j in range(len(relation_set_lengths)):
-            length = relation_set_lengths[j]
-            '''
-            cand_indexs = samples[j][1]
-            gold_pos = np.where(np.array(cand_indexs)
-                                == gold_relation_indexs[j])[0]
-            print('gold pos', gold_pos)
-            print('gold_index', gold_relation_indexs[j])
-            print('cand index', cand_indexs)
-            other_pos = np.where(np.array(cand_indexs)
-                                 != gold_relation_indexs[j])[0]
-            print('other_pos', other_pos)
-            '''
-            this_scores = all_scores[start_index:start_index + length]
-            gold_score = this_scores[0]
-            #print('gold score',gold_score)
-            neg_scores = this_scores[1:]
-            #print('neg score', neg_scores)
-            diff_scores.append(gold_score - neg_scores.max())
-            #print('scores:', all_scores[start_index:start_index+length])
-            #print('cand indexs:', cand_indexs)
-            #print('pred, true:',pred_index, gold_relation_indexs[j])
-            start_index += length
+                           question_lengths, relation_lengths,
+                           question_rows=question_rows,
+                           relation_rows=relation_rows)
+        # the gold relation is the first candidate, padding is -inf
+        scores, mask = pad_candidates(all_scores, relation_set_lengths)
+        diff_scores = list(scores[:, 0] - scores[:, 1:].max(1)[0])
         return diff_scores
-# evaluate the model on the testing data
-def evaluate_model(model, testing_data, batch_size, all_relations, device,
-                   reverse_model=None):
-    #print('start evaluate')
-    num_correct = 0
-    #testing_data = testing_data[0:100]
-    for i in range((len(testing_data)-1)//batch_size+1):
-        samples = testing_data[i*batch_size:(i+1)*batch_size]
-        gold_relation_indexs, questions, relations, relation_set_lengths = \
+# the number of samples whose best scored candidate is the gold relation
+def count_correct(all_scores, relation_ids, relation_set_lengths,
+                  gold_relation_indexs):
+    scores, mask = pad_candidates(all_scores, relation_set_lengths)
+    cand_indexs, _ = pad_candidates(relation_ids, relation_set_lengths, 0)
+    pred_pos = scores.argmax(1).to('cpu')
+    pred_indexs = cand_indexs[torch.arange(len(pred_pos)), pred_pos]
+    return int((pred_indexs == torch.tensor(gold_relation_indexs)).sum())
+
+# the sorted ids of all candidate relations of the samples
+def candidate_relations(samples):
+    if isinstance(samples, SampleStore):
+        return np.unique(samples.candidates()[0])
+    return np.unique(np.fromiter(
+        chain.from_iterable(sample[1] for sample in samples), dtype=np.int64))
+
+# the embeddings of the given relations, row i for relation_ids[i], after the
+# reverse model when one is given. The rows are normalized, so the cosine
+# with a normalized question is a dot product
+def compute_rel_index(model, relation_ids, all_relations, device,
+                      reverse_model=None):
+    rel_embeds = []
+    for i in range(0, len(relation_ids), rel_index_batch_size):
+        batch_ids = relation_ids[i:i+rel_index_batch_size]
+        pad_relations, relation_lengths, reverse_relation_indexs = \
+            all_relations.gather(batch_ids)
+        rel_embeds.append(model.compute_rel_embed(pad_relations,
+                                                  relation_lengths,
+                                                  reverse_relation_indexs,
+                                                  reverse_model))
+    return F.normalize(torch.cat(rel_embeds), dim=1)
+
+# batch_fn(all_scores, relation_ids, relation_set_lengths,
+# gold_relation_indexs) of every batch of the testing data, in the order of
+# the batches. Every batch only encodes its questions and scores them against
+# the rows of their candidates in rel_index, index_ids[i] being the relation
+# of row i
+def score_batches_indexed(batch_fn, model, testing_data, batches, index_ids,
+                          rel_index, all_relations, device,
+                          reverse_model=None):
+    results = []
+    with torch.no_grad():
+        for batch in batches:
+            samples = take_samples(testing_data, batch)
+            gold_relation_indexs, questions, relation_ids, \
+                relation_set_lengths = process_testing_samples(
+                    samples, all_relations, device)
+            if que_embed_cache.max_size > 0:
+                que_embeds = que_embed_cache.que_embeds(
+                    model, [sample[2] for sample in samples], device,
+                    reverse_model)
+            else:
+                ranked_questions, reverse_question_indexs = \
+                    ranking_sequence(questions)
+                question_lengths = [len(question)
+                                    for question in ranked_questions]
+                pad_questions = torch.nn.utils.rnn.pad_sequence(
+                    ranked_questions)
+                que_embeds = model.compute_que_embed(pad_questions,
+                                                     question_lengths,
+                                                     reverse_question_indexs,
+                                                     reverse_model)
+            que_embeds = F.normalize(que_embeds, dim=1)
+            question_rows = get_question_rows(relation_set_lengths, device)
+            rel_rows = torch.from_numpy(np.searchsorted(
+                index_ids, relation_ids.numpy())).to(device)
+            all_scores = (que_embeds[question_rows] *
+                          rel_index[rel_rows]).sum(1)
+            results.append(batch_fn(all_scores, relation_ids,
+                                    relation_set_lengths,
+                                    gold_relation_indexs))
+    return results
+
+# score_batches_indexed with every candidate encoded by the full model
+def score_batches_full(batch_fn, model, testing_data, batches, all_relations,
+                       device, reverse_model=None):
+    results = []
+    for batch in batches:
+        samples = take_samples(testing_data, batch)
+        gold_relation_indexs, questions, relation_ids, relation_set_lengths = \
             process_testing_samples(samples, all_relations, device)
-        model.init_hidden(device, sum(relation_set_lengths))
         ranked_questions, reverse_question_indexs = \
             ranking_sequence(questions)
-        ranked_relations, reverse_relation_indexs =\
-            ranking_sequence(relations)
+        pad_relations, relation_lengths, reverse_relation_indexs, \
+            relation_rows = all_relations.gather_unique(relation_ids)
+        question_rows = get_question_rows(relation_set_lengths, device)
         question_lengths = [len(question) for question in ranked_questions]
-        relation_lengths = [len(relation) for relation in ranked_relations]
         #print(ranked_questions)
         pad_questions = torch.nn.utils.rnn.pad_sequence(ranked_questions)
-        pad_relations = torch.nn.utils.rnn.pad_sequence(ranked_relations)
         all_scores = model(pad_questions, pad_relations, device,
                            reverse_question_indexs, reverse_relation_indexs,
-                           question_lengths, relation_lengths, reverse_model)
-        start_index = 0
-        pred_indexs = []
-        #print('len of relation_set:', len(relation_set_lengths))
-        for j in range(len(relation_set_lengths)):
-            length = relation_set_lengths[j]
-            cand_indexs = samples[j][1]
-            pred_index = (cand_indexs[
-                all_scores[start_index:start_index+length].argmax()])
-            if pred_index == gold_relation_indexs[j]:
-                num_correct += 1
-            #print('scores:', all_scores[start_index:start_index+length])
-            #print('cand indexs:', cand_indexs)
-            #print('pred, true:',pred_index, gold_relation_indexs[j])
-            start_index += length
-    #print(cand_scores[-1])
+                           question_lengths, relation_lengths, reverse_model,
+                           question_rows=question_rows,
+                           relation_rows=relation_rows)
+        results.append(batch_fn(all_scores, relation_ids,
+                                relation_set_lengths, gold_relation_indexs))
+    return results
+
+# score_fn(*args) in a forked worker of score_batches_sharded. The question
+# embeddings the worker adds to its copy of the cache are sent back with the
+# results
+def run_shard(score_fn, *args):
+    cached = set(que_embed_cache.embeds)
+    hits, misses = que_embed_cache.hits, que_embed_cache.misses
+    results = score_fn(*args)
+    new_embeds = [(key, embed.numpy())
+                  for key, embed in que_embed_cache.embeds.items()
+                  if key not in cached]
+    return results, new_embeds, que_embed_cache.hits-hits, \
+        que_embed_cache.misses-misses
+
+# score_fn over the batches split into contiguous shards, one per worker
+# process. Every batch is scored exactly as in the serial loop, so the merged
+# results are the serial ones. The new cached question embeddings are
+# inserted in the order of the shards, as the serial loop would have
+def score_batches_sharded(score_fn, batch_fn, model, testing_data, batches,
+                          args, workers):
+    shards = [shard for shard in np.array_split(np.arange(len(batches)),
+                                                workers) if len(shard) > 0]
+    shard_results = fork_map(run_shard,
+                             [(score_fn, batch_fn, model, testing_data,
+                               [batches[i] for i in shard]) + args
+                              for shard in shards], workers)
+    results = []
+    for batch_results, new_embeds, hits, misses in shard_results:
+        results += batch_results
+        for key, embed in new_embeds:
+            que_embed_cache.insert(key, torch.from_numpy(embed))
+        que_embed_cache.hits += hits
+        que_embed_cache.misses += misses
+    return results
+
+# the batches of the testing data and batch_fn of every batch under score_fn,
+# sharded over worker processes when workers > 1 and the model is on the
+# CPU. The accuracy does not depend on the order, so the batches are never
+# shuffled
+def map_batches(score_fn, batch_fn, model, testing_data, batch_size, args,
+                device, workers):
+    batches = get_batches(testing_data, batch_size, bucket_batches,
+                          batch_token_budget)
+    if workers > 1 and len(batches) > 1 and \
+            torch.device(device).type == 'cpu':
+        return batches, score_batches_sharded(score_fn, batch_fn, model,
+                                              testing_data, batches, args,
+                                              workers)
+    return batches, score_fn(batch_fn, model, testing_data, batches, *args)
+
+# the scoring loop of evaluate_model and its arguments after the batches.
+# With eval_rel_index every candidate relation of the testing data is
+# encoded once into an index first
+def scoring_loop(model, testing_data, all_relations, device,
+                 reverse_model=None):
+    if not eval_rel_index:
+        return score_batches_full, (all_relations, device, reverse_model)
+    with torch.no_grad():
+        index_ids = candidate_relations(testing_data)
+        rel_index = compute_rel_index(model, index_ids, all_relations,
+                                      device, reverse_model)
+    return score_batches_indexed, (index_ids, rel_index, all_relations,
+                                   device, reverse_model)
+
+# evaluate a TorchScript scorer exported by export_model.py
+def evaluate_scripted_model(scorer, testing_data, batch_size, all_relations,
+                            device):
+    num_correct = 0
+    with torch.no_grad():
+        for batch in get_batches(testing_data, batch_size, bucket_batches,
+                                 batch_token_budget):
+            samples = take_samples(testing_data, batch)
+            gold_relation_indexs, questions, relation_ids, \
+                relation_set_lengths = process_testing_samples(
+                    samples, all_relations, device)
+            all_scores = scripted_scores(scorer, questions, relation_ids,
+                                         relation_set_lengths, all_relations,
+                                         device)
+            num_correct += count_correct(all_scores, relation_ids,
+                                         relation_set_lengths,
+                                         gold_relation_indexs)
+    return float(num_correct)/len(testing_data)
+
+# evaluate the model on the testing data, on eval_workers processes by default
+def evaluate_model(model, testing_data, batch_size, all_relations, device,
+                   reverse_model=None, workers=None):
+    if workers is None:
+        workers = eval_workers
+    #print('start evaluate')
+    #testing_data = testing_data[0:100]
+    score_fn, args = scoring_loop(model, testing_data, all_relations, device,
+                                  reverse_model)
+    _, num_correct = map_batches(score_fn, count_correct, model, testing_data,
+                                 batch_size, args, device, workers)
     #print('num correct:', num_correct)
     #print('correct rate:', float(num_correct)/len(testing_data))
-    return float(num_correct)/len(testing_data)
+    return float(sum(num_correct))/len(testing_data)
+
+def batch_scores(all_scores, relation_ids, relation_set_lengths,
+                 gold_relation_indexs):
+    return all_scores.detach().cpu().numpy()
+
+# the scores of the candidates of the samples of a SampleStore, kept by
+# source row of the sample and candidate relation. Every view or filtered
+# copy of the same samples then gets the accuracy evaluate_model would give
+# it without being scored again, whatever candidates it kept (see
+# remove_unseen_relation)
+class CandidateScores(object):
+    def __init__(self, store, scores):
+        cands, cand_offsets = store.candidates()
+        self.key_base = int(cands.max())+1 if len(cands) > 0 else 1
+        keys = self.keys(store.source_ids(), cands, cand_offsets)
+        order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[order]
+        self.sorted_scores = scores[order]
+
+    def keys(self, rows, cands, cand_offsets):
+        return np.repeat(rows.astype(np.int64), np.diff(cand_offsets)) * \
+            self.key_base + cands
+
+    # a sample is correct when its best scored candidate in the view, the
+    # first one on ties, is the gold relation
+    def accuracy(self, store):
+        cands, cand_offsets = store.candidates()
+        keys = self.keys(store.source_ids(), cands, cand_offsets)
+        positions = np.minimum(np.searchsorted(self.sorted_keys, keys),
+                               len(self.sorted_keys)-1)
+        if len(keys) > 0 and np.any(self.sorted_keys[positions] != keys):
+            raise ValueError('the view has candidates that were not scored')
+        scores = self.sorted_scores[positions]
+        lengths = np.diff(cand_offsets)
+        non_empty = lengths > 0
+        starts = cand_offsets[:-1][non_empty]
+        num_correct = 0
+        if len(starts) > 0:
+            best_scores = np.maximum.reduceat(scores, starts)
+            is_best = scores == np.repeat(best_scores, lengths[non_empty])
+            best_positions = np.minimum.reduceat(
+                np.where(is_best, np.arange(len(scores)), len(scores)),
+                starts)
+            num_correct = int((cands[best_positions] ==
+                               store.relations()[non_empty]).sum())
+        return float(num_correct)/len(store)
+
+# the scores of every candidate of the testing data (a SampleStore) from one
+# pass of the scoring loop of evaluate_model
+def score_candidates(model, testing_data, batch_size, all_relations, device,
+                     reverse_model=None, workers=None):
+    if workers is None:
+        workers = eval_workers
+    score_fn, args = scoring_loop(model, testing_data, all_relations, device,
+                                  reverse_model)
+    batches, results = map_batches(score_fn, batch_scores, model,
+                                   testing_data, batch_size, args, device,
+                                   workers)
+    cands, cand_offsets = testing_data.candidates()
+    positions = np.arange(len(cands))
+    scores = np.empty(len(cands), dtype=np.float32)
+    for batch, batch_result in zip(batches, results):
+        scores[gather_csr(cand_offsets, positions,
+                          np.asarray(batch, dtype=np.int64))[0]] = batch_result
+    return CandidateScores(testing_data, scores)
 
+# python evaluate.py [--scripted | --quantized]
+# --quantized evaluates the dynamic int8 copy of the model on the CPU
 if __name__ == '__main__':
-    model = torch.load(model_path)
     training_data, testing_data, valid_data,\
         all_relations, vocabulary,  embedding = gen_data()
-    model.init_embedding(np.array(embedding))
-    acc=evaluate_model(model, testing_data, batch_size, all_relations, device)
+    if len(sys.argv) > 1 and sys.argv[1] == '--quantized':
+        from quantize import quantize_model
+        device = 'cpu'
+    all_relations = RelationBank(all_relations, device)
+    if len(sys.argv) > 1 and sys.argv[1] == '--scripted':
+        scorer = torch.jit.load(scripted_model_path, map_location=device)
+        acc = evaluate_scripted_model(scorer, testing_data, batch_size,
+                                      all_relations, device)
+    else:
+        model = torch.load(model_path, map_location=device,
+                           weights_only=False)
+        model.init_embedding(np.array(embedding))
+        if len(sys.argv) > 1 and sys.argv[1] == '--quantized':
+            model = quantize_model(model)
+        acc=evaluate_model(model, testing_data, batch_size, all_relations,
+                           device)
     print('accuracy:', acc)
@@ -0,0 +1,87 @@
+import sys
+import time
+import numpy as np
+import torch
+
+from data import gen_data
+from model import ScriptableScorer
+from evaluate import evaluate_model, evaluate_scripted_model
+from utils import RelationBank, process_testing_samples, ranking_sequence, \
+    get_question_rows, scripted_scores
+from config import CONFIG as conf
+
+model_path = conf['model_path']
+scripted_model_path = conf['scripted_model_path']
+batch_size = conf['batch_size']
+device = conf['device']
+
+# compile the encoders and the scoring head of the model (with the reverse
+# model when one is given) to TorchScript and save them, the frozen word
+# embeddings included. The saved file loads with torch.jit.load alone,
+# without model.py
+def export_scorer(model, file_name, reverse_model=None):
+    scorer = torch.jit.script(ScriptableScorer(model, reverse_model))
+    scorer.save(file_name)
+    return scorer
+
+def load_scorer(file_name, device):
+    return torch.jit.load(file_name, map_location=device)
+
+# the largest difference between the candidate scores of the eager model and
+# of the scorer on the samples
+def max_score_diff(model, scorer, samples, all_relations, device,
+                   reverse_model=None):
+    max_diff = 0.0
+    with torch.no_grad():
+        for start in range(0, len(samples), batch_size):
+            _, questions, relation_ids, relation_set_lengths = \
+                process_testing_samples(samples[start:start+batch_size],
+                                        all_relations, device)
+            ranked_questions, reverse_question_indexs = \
+                ranking_sequence(questions)
+            pad_relations, relation_lengths, reverse_relation_indexs, \
+                relation_rows = all_relations.gather_unique(relation_ids)
+            question_rows = get_question_rows(relation_set_lengths, device)
+            question_lengths = [len(question) for question in ranked_questions]
+            pad_questions = torch.nn.utils.rnn.pad_sequence(ranked_questions)
+            eager_scores = model(pad_questions, pad_relations, device,
+                                 reverse_question_indexs,
+                                 reverse_relation_indexs, question_lengths,
+                                 relation_lengths, reverse_model,
+                                 question_rows=question_rows,
+                                 relation_rows=relation_rows)
+            scores = scripted_scores(scorer, questions, relation_ids,
+                                     relation_set_lengths, all_relations,
+                                     device)
+            max_diff = max(max_diff,
+                           float((eager_scores - scores).abs().max()))
+    return max_diff
+
+# python export_model.py [MODEL_PATH [SCRIPTED_MODEL_PATH]]
+# exports the model and checks the export against it on the testing data
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        model_path = sys.argv[1]
+    if len(sys.argv) > 2:
+        scripted_model_path = sys.argv[2]
+    start_time = time.time()
+    model = torch.load(model_path, map_location=device, weights_only=False)
+    print('eager model loaded in %.3f s' % (time.time()-start_time))
+    training_data, testing_data, valid_data,\
+        all_relations, vocabulary,  embedding = gen_data()
+    all_relations = RelationBank(all_relations, device)
+    model.init_embedding(np.array(embedding))
+    export_scorer(model, scripted_model_path)
+    start_time = time.time()
+    scorer = load_scorer(scripted_model_path, device)
+    print('scripted model loaded in %.3f s' % (time.time()-start_time))
+    start_time = time.time()
+    acc = evaluate_model(model, testing_data, batch_size, all_relations,
+                         device)
+    print('eager accuracy %.6f, %.3f s' % (acc, time.time()-start_time))
+    start_time = time.time()
+    acc = evaluate_scripted_model(scorer, testing_data, batch_size,
+                                  all_relations, device)
+    print('scripted accuracy %.6f, %.3f s' % (acc, time.time()-start_time))
+    print('max score difference: %g' % max_score_diff(
+        model, scorer, testing_data, all_relations, device))
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+from parallel_io import map_file_chunks
+from config import CONFIG as conf
+
+glove_file = conf['glove_file']
+
+# the binary store sits beside the text file: <name>.npy keeps the float32
+# matrix and <name>.vocab keeps one word per line, line i is row i
+def store_paths(glove_file):
+    prefix = os.path.splitext(glove_file)[0]
+    return prefix + '.npy', prefix + '.vocab'
+
+# the store is valid if both files exist and are not older than the text file
+def store_is_fresh(glove_file):
+    matrix_file, vocab_file = store_paths(glove_file)
+    if not (os.path.exists(matrix_file) and os.path.exists(vocab_file)):
+        return False
+    source_time = os.path.getmtime(glove_file)
+    return os.path.getmtime(matrix_file) >= source_time and \
+        os.path.getmtime(vocab_file) >= source_time
+
+def parse_glove_lines(lines):
+    words = []
+    vectors = []
+    for line in lines:
+        items = line.rstrip().split(' ')
+        words.append(items[0])
+        vectors.append(np.asarray(items[1:], dtype='float32'))
+    return words, np.vstack(vectors)
+
+# parse the glove text file once and write the binary store
+def convert_glove(glove_file):
+    chunks = map_file_chunks(parse_glove_lines, glove_file)
+    words = [word for chunk in chunks for word in chunk[0]]
+    matrix = np.concatenate([chunk[1] for chunk in chunks])
+    matrix_file, vocab_file = store_paths(glove_file)
+    # write to temporary names first so a killed run never leaves a
+    # half-written store that looks fresh
+    np.save(matrix_file + '.tmp.npy', matrix)
+    with open(vocab_file + '.tmp', 'w', newline='') as file_out:
+        file_out.write('\n'.join(words) + '\n')
+    os.replace(matrix_file + '.tmp.npy', matrix_file)
+    os.replace(vocab_file + '.tmp', vocab_file)
+
+# word -> vector lookup backed by a memory-mapped matrix. It supports the
+# same "word in glove" and "glove[word]" usage as the old dict of arrays
+class GloveStore(object):
+    def __init__(self, words, matrix):
+        self.words = words
+        self.word_index = {word: i for i, word in enumerate(words)}
+        self.matrix = matrix
+
+    def __contains__(self, word):
+        return word in self.word_index
+
+    def __getitem__(self, word):
+        return self.matrix[self.word_index[word]]
+
+    def __len__(self):
+        return len(self.words)
+
+    def get(self, word, default=None):
+        row = self.word_index.get(word)
+        if row is None:
+            return default
+        return self.matrix[row]
+
+    def keys(self):
+        return self.word_index.keys()
+
+# open the binary store, building it from the text file on first use
+def load_glove_store(glove_file=glove_file):
+    if not store_is_fresh(glove_file):
+        convert_glove(glove_file)
+    matrix_file, vocab_file = store_paths(glove_file)
+    matrix = np.load(matrix_file, mmap_mode='r')
+    with open(vocab_file, newline='') as file_in:
+        words = file_in.read().split('\n')[:-1]
+    return GloveStore(words, matrix)
+
+if __name__ == '__main__':
+    convert_glove(glove_file)
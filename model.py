@@ -25,34 +25,14 @@ class BiLSTM(nn.Module):
         self.lstm = nn.LSTM(embedding_dim, hidden_dim, bidirectional=True)
 
         #self.maxpool = nn.MaxPool1d(hidden_dim*2)
-        self.hidden = self.build_hidden()
-
-    def build_hidden(self, batch_size = 1):
-        # Before we've done anything, we dont have any hidden state.
-        # Refer to the Pytorch documentation to see exactly
-        # why they have this dimensionality.
-        # The axes semantics are (num_layers, minibatch_size, hidden_dim)
-        #print(batch_size)
-        return [torch.zeros(2, batch_size, self.hidden_dim),
-                torch.zeros(2, batch_size, self.hidden_dim)]
-
-    def init_hidden(self, device='cpu', batch_size = 1):
-        # Before we've done anything, we dont have any hidden state.
-        # Refer to the Pytorch documentation to see exactly
-        # why they have this dimensionality.
-        # The axes semantics are (num_layers, minibatch_size, hidden_dim)
-        #print(batch_size)
-        self.hidden = (torch.zeros(2, batch_size, self.hidden_dim).to(device),
-                torch.zeros(2, batch_size, self.hidden_dim).to(device))
-        #self.hidden[0] = self.hidden[0].to(device)
-        #self.hidden[1] = self.hidden[1].to(device)
-
-    def forward(self, packed_embeds):
+
+    # hidden is the initial (h, c) state, zeros when it is None. The module
+    # is not changed, so one model can serve several threads at once
+    def forward(self, packed_embeds, hidden=None):
         #print(packed_embeds)
-        #print(self.hidden)
-        lstm_out, self.hidden = self.lstm(packed_embeds, self.hidden)
+        lstm_out, (last_hidden, last_cell) = self.lstm(packed_embeds, hidden)
         #maxpool_hidden = self.maxpool(lstm_out.view(1,len(sentence), -1))
-        permuted_hidden = self.hidden[0].permute([1,0,2]).contiguous()
+        permuted_hidden = last_hidden.permute([1,0,2]).contiguous()
         #print(permuted_hidden.size())
         return permuted_hidden.view(-1, self.hidden_dim*2)
 
@@ -70,13 +50,13 @@ class SimilarityModel(nn.Module):
         self.relation_biLstm = BiLSTM(embedding_dim, hidden_dim, vocab_size,
                                       vocab_embedding, batch_size, device)
 
-    def init_hidden(self, device, batch_size=1):
-        self.sentence_biLstm.init_hidden(device, batch_size)
-        self.relation_biLstm.init_hidden(device, batch_size)
-
+    # copied in place outside autograd rather than through .data, so the
+    # version of the weight changes and cached question embeddings expire
     def init_embedding(self, vocab_embedding):
         #print(self.word_embeddings(torch.tensor([27]).cuda()))
-        self.word_embeddings.weight.data.copy_(torch.from_numpy(vocab_embedding))
+        with torch.no_grad():
+            self.word_embeddings.weight.copy_(
+                torch.from_numpy(vocab_embedding))
         #print(self.word_embeddings(torch.tensor([27]).cuda()))
 
     def ranking_sequence(self, sequence):
@@ -118,7 +98,7 @@ class SimilarityModel(nn.Module):
     def forward(self, question_list, relation_list, device,
                 reverse_question_indexs, reverse_relation_indexs,
                 question_lengths, relation_lengths, reverse_model=None,
-                ret_embeds=False):
+                ret_embeds=False, question_rows=None, relation_rows=None):
         '''
         question_embeds = [self.word_embeddings(sentence)
                            for sentence in question_list]
@@ -156,9 +136,23 @@ class SimilarityModel(nn.Module):
         #print('relation_embedding size', relation_embedding.size())
         #print('sentence_embedding', sentence_embedding)
         #print('relation_embedding', relation_embedding)
+        # each question and each distinct relation is encoded once, then
+        # copied to its candidate rows. Indexing sums the gradients of the
+        # copies back into the shared row
         if reverse_model is not None:
             reverse_question_embedding = reverse_model(question_embedding)
             reverse_relation_embedding = reverse_model(relation_embedding)
+            if question_rows is not None:
+                reverse_question_embedding = \
+                    reverse_question_embedding[question_rows]
+            if relation_rows is not None:
+                reverse_relation_embedding = \
+                    reverse_relation_embedding[relation_rows]
+        if question_rows is not None:
+            question_embedding = question_embedding[question_rows]
+        if relation_rows is not None:
+            relation_embedding = relation_embedding[relation_rows]
+        if reverse_model is not None:
             cos = nn.CosineSimilarity(dim=1)
             origin_score =  cos(question_embedding, relation_embedding)
             reverse_score =  cos(reverse_question_embedding,
@@ -180,3 +174,54 @@ class SimilarityModel(nn.Module):
             else:
                 return cos(question_embedding, relation_embedding),\
                     question_embedding, relation_embedding
+
+# the embedding and one BiLSTM of a SimilarityModel as a module TorchScript
+# can compile. The tokens are a padded (length, batch) matrix in any order,
+# the rows of the output follow the columns of the input
+class ScriptableEncoder(nn.Module):
+    def __init__(self, word_embeddings, bilstm):
+        super(ScriptableEncoder, self).__init__()
+        self.word_embeddings = word_embeddings
+        self.lstm = bilstm.lstm
+        self.hidden_dim = bilstm.hidden_dim
+
+    def forward(self, tokens, lengths):
+        packed = torch.nn.utils.rnn.pack_padded_sequence(
+            self.word_embeddings(tokens), lengths, enforce_sorted=False)
+        lstm_out, (last_hidden, last_cell) = self.lstm(packed)
+        return last_hidden.permute([1, 0, 2]).reshape(-1, self.hidden_dim*2)
+
+# the question and relation encoders of a SimilarityModel and its cosine
+# scoring head, with the reverse model applied to both embeddings when one is
+# given, like SimilarityModel.forward. The question of candidate i is
+# question_rows[i] and its relation is relation_rows[i]
+class ScriptableScorer(nn.Module):
+    def __init__(self, model, reverse_model=None):
+        super(ScriptableScorer, self).__init__()
+        self.question_encoder = ScriptableEncoder(model.word_embeddings,
+                                                  model.sentence_biLstm)
+        self.relation_encoder = ScriptableEncoder(model.word_embeddings,
+                                                  model.relation_biLstm)
+        if reverse_model is None:
+            self.reverse = nn.Identity()
+        else:
+            self.reverse = reverse_model.linear
+
+    @torch.jit.export
+    def encode_questions(self, questions, question_lengths):
+        return self.reverse(self.question_encoder(questions,
+                                                  question_lengths))
+
+    @torch.jit.export
+    def encode_relations(self, relations, relation_lengths):
+        return self.reverse(self.relation_encoder(relations,
+                                                  relation_lengths))
+
+    def forward(self, questions, question_lengths, relations,
+                relation_lengths, question_rows, relation_rows):
+        question_embedding = self.encode_questions(questions,
+                                                   question_lengths)
+        relation_embedding = self.encode_relations(relations,
+                                                   relation_lengths)
+        return F.cosine_similarity(question_embedding[question_rows],
+                                   relation_embedding[relation_rows], dim=1)
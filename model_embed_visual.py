@@ -3,6 +3,8 @@ from sklearn.decomposition import PCA
 from matplotlib import pyplot
 from data import gen_data, read_origin_relation
 from config import CONFIG as conf
+from bert_feature import read_embedding
+from rel_embed_snapshot import load_rel_embed_snapshot, load_rel_embed_series
 
 bert_feature_file = conf['bert_feature_file']
 
@@ -14,14 +16,6 @@ def read_relation_name(file_name):
             ret_names.append(line[:-1])
     return ret_names
 
-def read_embedding(file_name):
-    ret_np = []
-    with open(file_name) as file_in:
-        for line in file_in:
-            ret_np.append(np.fromstring(line[1:-2], dtype=float, sep=','))
-    #print(ret_np)
-    return np.asarray(ret_np)
-
 def compute_rel_embed(training_data, relation_names=None):
     que_rel_embeddings = read_embedding(bert_feature_file)
     rel_indexs = {}
@@ -40,8 +34,8 @@ def compute_rel_embed(training_data, relation_names=None):
         '''
     rel_embed = {}
     for rel in rel_indexs:
-        que_rel_embeds = [que_rel_embeddings[i] for i in rel_indexs[rel]]
-        rel_embed[rel] = np.mean(que_rel_embeds, 0)
+        que_rel_embeds = que_rel_embeddings[rel_indexs[rel]]
+        rel_embed[rel] = np.mean(que_rel_embeds, 0, dtype=np.float64)
     rel_ids = rel_embed.keys()
     if relation_names is not None:
         rel_names = [relation_names[rel_indexs[i][0]].split('|||')[1]
@@ -52,18 +46,7 @@ def compute_rel_embed(training_data, relation_names=None):
         return rel_embed
 
 def read_model_embeds(file_name):
-    rels = []
-    ret_np = []
-    is_first_line = True
-    with open(file_name) as file_in:
-        for line in file_in:
-            if is_first_line:
-                rels = np.fromstring(line[1:-2], dtype=int, sep=',')
-                is_first_line = False
-            else:
-                ret_np.append(np.fromstring(line[1:-2], dtype=float, sep=','))
-    #print(ret_np)
-    return rels, np.asarray(ret_np)
+    return load_rel_embed_snapshot(file_name)
 
 # visualize using PCA
 def visualize_PCA(X, names, draw_text=True):
@@ -86,10 +69,10 @@ def visualize_PCA(X, names, draw_text=True):
     '''
 
 if __name__ == "__main__":
-    for num_file in list(range(20)):
-        file_name = 'model_embed/embed'+str(num_file)+'.txt'
-        rels, rel_embeds = read_model_embeds(file_name)
-        all_relation_names = read_origin_relation()
+    file_names = ['model_embed/embed'+str(num_file)+'.bin'
+                  for num_file in range(20)]
+    all_relation_names = read_origin_relation()
+    for rels, rel_embeds in load_rel_embed_series(file_names):
         rel_names = [all_relation_names[i] for i in rels]
         visualize_PCA(rel_embeds, rel_names, False)
         #num_samples_2_visual = len(relation_embeddings)
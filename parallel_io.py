@@ -0,0 +1,86 @@
+import io
+import os
+import multiprocessing
+from multiprocessing import Pool
+import torch
+from config import CONFIG as conf
+
+num_workers = conf['num_workers']
+# files smaller than this are parsed in the calling process
+min_chunk_size = 1 << 22
+
+# split the file into at most num_chunks byte ranges that start right after a
+# line break, so every chunk holds whole lines
+def chunk_offsets(file_name, num_chunks):
+    size = os.path.getsize(file_name)
+    offsets = [0]
+    with open(file_name, 'rb') as file_in:
+        for i in range(1, num_chunks):
+            file_in.seek(max(size*i//num_chunks - 1, offsets[-1]))
+            file_in.readline()
+            offset = file_in.tell()
+            if offset >= size:
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    offsets.append(size)
+    return offsets
+
+# read the lines between the two offsets. TextIOWrapper decodes and splits the
+# lines the same way as iterating over open(file_name)
+def read_chunk_lines(file_name, start, end):
+    with open(file_name, 'rb') as file_in:
+        file_in.seek(start)
+        return io.TextIOWrapper(io.BytesIO(file_in.read(end-start)))
+
+def parse_chunk(args):
+    parse_lines, file_name, start, end = args
+    return parse_lines(read_chunk_lines(file_name, start, end))
+
+# parse the file with parse_lines(lines), which must be a module level function
+# so it can be sent to the workers. The file is split by byte offsets and the
+# chunks are parsed in a process pool. Returns the results of the chunks in
+# the order of the file
+def map_file_chunks(parse_lines, file_name, workers=None):
+    if workers is None:
+        workers = num_workers
+    if workers <= 1 or os.path.getsize(file_name) < min_chunk_size:
+        with open(file_name) as file_in:
+            return [parse_lines(file_in)]
+    # a few chunks per worker keep the pool busy when lines are uneven
+    offsets = chunk_offsets(file_name, workers*4)
+    chunks = [(parse_lines, file_name, offsets[i], offsets[i+1])
+              for i in range(len(offsets)-1)]
+    with Pool(min(workers, len(chunks))) as pool:
+        return pool.map(parse_chunk, chunks)
+
+# the function and arguments of fork_map, set right before the pool forks so
+# the workers inherit them instead of receiving them pickled
+fork_task = None
+
+# one intra-op thread per worker, the workers already keep the cores busy
+def init_fork_worker():
+    torch.set_num_threads(1)
+
+def run_fork_task(i):
+    fn, args_list = fork_task
+    return fn(*args_list[i])
+
+# [fn(*args) for args in args_list] with the calls spread over a pool of
+# forked processes. fn and its arguments (models and tensors included) are
+# not pickled: the workers inherit the address space of the parent, whose
+# pages stay shared as long as they are only read. Only the results are
+# pickled back. The tensors must be on the CPU
+def fork_map(fn, args_list, workers=None):
+    global fork_task
+    if workers is None:
+        workers = num_workers
+    if workers <= 1 or len(args_list) <= 1:
+        return [fn(*args) for args in args_list]
+    fork_task = (fn, args_list)
+    try:
+        with multiprocessing.get_context('fork').Pool(
+                min(workers, len(args_list)), init_fork_worker) as pool:
+            return pool.map(run_fork_task, range(len(args_list)), 1)
+    finally:
+        fork_task = None
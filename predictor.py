@@ -0,0 +1,275 @@
+import sys
+import json
+import time
+import asyncio
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+from data import gen_data
+from utils import RelationBank, process_testing_samples, ranking_sequence, \
+    get_question_rows, scripted_scores
+from quantize import quantize_model
+from config import CONFIG as conf
+
+model_path = conf['model_path']
+scripted_model_path = conf['scripted_model_path']
+device = conf['device']
+predict_max_batch_size = conf['predict_max_batch_size']
+predict_max_latency = conf['predict_max_latency']
+
+# the model, vocabulary and relation bank, loaded once and kept resident.
+# A request is a question (a string split on whitespace like the samples,
+# or a list of vocabulary ids) and the ids of its candidate relations. The
+# model is a SimilarityModel or a scorer exported by export_model.py
+class Predictor(object):
+    def __init__(self, model, vocabulary, all_relations, device,
+                 reverse_model=None):
+        self.model = model
+        self.vocabulary = vocabulary
+        self.all_relations = all_relations
+        self.device = device
+        self.reverse_model = reverse_model
+
+    # the question as vocabulary ids, words out of the vocabulary are dropped
+    def question_ids(self, question):
+        if isinstance(question, str):
+            question = [self.vocabulary[word] for word in question.split()
+                        if word in self.vocabulary]
+        question = [int(word) for word in question]
+        if len(question) == 0:
+            raise ValueError('the question has no word in the vocabulary')
+        for word in question:
+            if word < 0 or word >= len(self.vocabulary):
+                raise ValueError('unknown word id %d' % word)
+        return question
+
+    def check_candidates(self, candidates):
+        candidates = [int(cand) for cand in candidates]
+        if len(candidates) == 0:
+            raise ValueError('no candidate relations')
+        for cand in candidates:
+            if cand <= 0 or cand >= len(self.all_relations):
+                raise ValueError('unknown relation id %d' % cand)
+        return candidates
+
+    # the scores of the candidates of every (question ids, candidates) pair
+    def predict_batch(self, requests):
+        samples = [[0, candidates, question]
+                   for question, candidates in requests]
+        with torch.no_grad():
+            _, questions, relation_ids, relation_set_lengths = \
+                process_testing_samples(samples, self.all_relations,
+                                        self.device)
+            if isinstance(self.model, torch.jit.ScriptModule):
+                all_scores = scripted_scores(self.model, questions,
+                                             relation_ids,
+                                             relation_set_lengths,
+                                             self.all_relations, self.device)
+                return np.split(all_scores.cpu().numpy(),
+                                np.cumsum(relation_set_lengths)[:-1])
+            ranked_questions, reverse_question_indexs = \
+                ranking_sequence(questions)
+            pad_relations, relation_lengths, reverse_relation_indexs, \
+                relation_rows = self.all_relations.gather_unique(relation_ids)
+            question_rows = get_question_rows(relation_set_lengths,
+                                              self.device)
+            question_lengths = [len(question) for question in ranked_questions]
+            pad_questions = torch.nn.utils.rnn.pad_sequence(ranked_questions)
+            all_scores = self.model(pad_questions, pad_relations, self.device,
+                                    reverse_question_indexs,
+                                    reverse_relation_indexs, question_lengths,
+                                    relation_lengths, self.reverse_model,
+                                    question_rows=question_rows,
+                                    relation_rows=relation_rows)
+        return np.split(all_scores.cpu().numpy(),
+                        np.cumsum(relation_set_lengths)[:-1])
+
+# coalesces concurrent predict calls into micro-batches. The first request
+# of a batch waits at most max_latency seconds for others to join, up to
+# max_batch_size requests. The batches are scored one at a time in a worker
+# thread, so the event loop keeps reading requests meanwhile
+class MicroBatcher(object):
+    def __init__(self, predictor, max_batch_size=None, max_latency=None):
+        if max_batch_size is None:
+            max_batch_size = predict_max_batch_size
+        if max_latency is None:
+            max_latency = predict_max_latency
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1)
+
+    # the candidate scores of one request. Invalid requests raise ValueError
+    # here, before they can fail a batch
+    async def predict(self, question, candidates):
+        request = (self.predictor.question_ids(question),
+                   self.predictor.check_candidates(candidates))
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(),
+                                                    timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.predictor.predict_batch,
+                    [request for request, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (_, future), scores in zip(batch, results):
+                if not future.done():
+                    future.set_result(scores)
+
+# answer one JSON line {"id": ..., "question": ..., "candidates": [...]} with
+# {"id": ..., "relation": best candidate, "scores": [...]} or
+# {"id": ..., "error": message}
+async def handle_line(batcher, line):
+    request_id = None
+    try:
+        request = json.loads(line)
+        request_id = request.get('id')
+        candidates = request['candidates']
+        scores = await batcher.predict(request['question'], candidates)
+        response = {'id': request_id,
+                    'relation': int(candidates[int(np.argmax(scores))]),
+                    'scores': scores.tolist()}
+    except Exception as error:
+        response = {'id': request_id, 'error': str(error)}
+    return json.dumps(response) + '\n'
+
+# serve the requests of one stream, answering each as soon as it is scored.
+# The responses may come out of order, the ids tell them apart
+async def serve_stream(batcher, reader, write):
+    pending = set()
+    async def answer(line):
+        write(await handle_line(batcher, line))
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if line.strip():
+            task = asyncio.ensure_future(answer(line))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    if len(pending) > 0:
+        await asyncio.wait(pending)
+
+# reads stdin in a thread of its own, which works whether stdin is a pipe, a
+# file or a terminal
+class StdinReader(object):
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(1)
+
+    async def readline(self):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, sys.stdin.buffer.readline)
+
+async def serve_stdio(batcher):
+    reader = StdinReader()
+    def write(response):
+        sys.stdout.write(response)
+        sys.stdout.flush()
+    await serve_stream(batcher, reader, write)
+
+async def serve_socket(batcher, socket_path):
+    async def handle_client(reader, writer):
+        def write(response):
+            writer.write(response.encode('utf8'))
+        await serve_stream(batcher, reader, write)
+        await writer.drain()
+        writer.close()
+    server = await asyncio.start_unix_server(handle_client, socket_path)
+    async with server:
+        await server.serve_forever()
+
+async def serve(predictor, socket_path=None):
+    batcher = MicroBatcher(predictor)
+    runner = asyncio.ensure_future(batcher.run())
+    try:
+        if socket_path is None:
+            await serve_stdio(batcher)
+        else:
+            await serve_socket(batcher, socket_path)
+    finally:
+        runner.cancel()
+
+# latency percentiles and throughput of num_clients clients that send the
+# samples one request after the other
+async def load_test(predictor, samples, num_clients=32):
+    batcher = MicroBatcher(predictor)
+    runner = asyncio.ensure_future(batcher.run())
+    latencies = []
+    async def client(client_samples):
+        for sample in client_samples:
+            start_time = time.perf_counter()
+            await batcher.predict(list(sample[2]), sample[1])
+            latencies.append(time.perf_counter()-start_time)
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client(samples[i::num_clients])
+                           for i in range(num_clients)])
+    total_time = time.perf_counter()-start_time
+    runner.cancel()
+    latencies = np.array(latencies)*1000
+    print('%d requests, %d clients: %.1f requests/s, latency p50 %.2f ms, '
+          'p99 %.2f ms' % (len(latencies), num_clients,
+                           len(latencies)/total_time,
+                           np.percentile(latencies, 50),
+                           np.percentile(latencies, 99)))
+    return latencies
+
+# the quantized model runs on the CPU
+def load_predictor(scripted=False, quantized=False):
+    model_device = 'cpu' if quantized else device
+    training_data, testing_data, valid_data,\
+        all_relations, vocabulary,  embedding = gen_data()
+    all_relations = RelationBank(all_relations, model_device)
+    if scripted:
+        model = torch.jit.load(scripted_model_path, map_location=model_device)
+    else:
+        model = torch.load(model_path, map_location=model_device,
+                           weights_only=False)
+        model.init_embedding(np.array(embedding))
+        if quantized:
+            model = quantize_model(model)
+    return Predictor(model, vocabulary, all_relations, model_device), \
+        testing_data
+
+# python predictor.py [FLAGS]                 JSON lines on stdin/stdout
+# python predictor.py [FLAGS] SOCKET_PATH     JSON lines on a unix socket
+# python predictor.py [FLAGS] --load-test     latency under concurrent load
+# --scripted serves the TorchScript export of export_model.py, --quantized
+# serves the dynamic int8 copy of the model on the CPU
+if __name__ == '__main__':
+    flags = ['--scripted', '--quantized']
+    args = [arg for arg in sys.argv[1:] if arg not in flags]
+    predictor, testing_data = load_predictor('--scripted' in sys.argv[1:],
+                                             '--quantized' in sys.argv[1:])
+    if len(args) > 0 and args[0] == '--load-test':
+        asyncio.run(load_test(predictor, testing_data))
+    else:
+        asyncio.run(serve(predictor, args[0] if len(args) > 0 else None))
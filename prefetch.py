@@ -0,0 +1,28 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import CONFIG as conf
+
+prefetch_batches = conf['prefetch_batches']
+prefetch_workers = conf['prefetch_workers']
+
+# iterate over fn(*args) for every args of args_list, in order, while worker
+# threads already compute the next results. At most depth results are
+# computed ahead of the consumer, so the prepared batches waiting on the
+# device stay bounded. With depth 0 everything runs in the calling thread
+def prefetch_map(fn, args_list, depth=None, workers=None):
+    if depth is None:
+        depth = prefetch_batches
+    if workers is None:
+        workers = prefetch_workers
+    if depth <= 0 or workers <= 0:
+        for args in args_list:
+            yield fn(*args)
+        return
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for args in args_list:
+            pending.append(pool.submit(fn, *args))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
@@ -1,5 +1,5 @@
 import numpy as np
-import wordninja
+from relation_tokenizer import RelationTokenizer
 from config import CONFIG as conf
 
 relation_file = conf['relation_file']
@@ -57,34 +57,11 @@ def concat_words(words, con_sym = '_'):
         return_str += con_sym + word
     return return_str
 
-# split the relation into words together with relation name, eg. birth_place_of
-# will be turned into [birth, place, of, birth_place_of]
-def split_relation_into_words(relation, glove_vocabulary):
-    word_list = []
-    relation_list = []
-    # some relation will have fours parts, where the first part looks like
-    # "base". We only choose the last three parts
-    for word_seq in relation.split("/")[-3:]:
-        new_word_list = []
-        for word in word_seq.split("_"):
-            #print(word)
-            if word not in glove_vocabulary:
-                new_word_list += wordninja.split(word)
-            else:
-                new_word_list += [word]
-        #print(new_word_list)
-        word_list += new_word_list
-        relation_list.append(concat_words(new_word_list))
-    #return word_list+relation_list
-    return word_list
-
 # some words are put together, such computerscience. Need to split these words
 # in the samples, and will split the relation
 def clean_relations(relation_list, glove_vocabulary):
-    cleaned_relations = []
-    for relation in relation_list:
-        cleaned_relations.append(split_relation_into_words(relation, glove_vocabulary))
-    return cleaned_relations
+    tokenizer = RelationTokenizer(glove_vocabulary)
+    return tokenizer.split_relations(relation_list)
 
 # build the vocabulary and embedding from the relations and questions based on
 # the glove embeddings
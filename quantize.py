@@ -0,0 +1,95 @@
+import io
+import os
+import sys
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, \
+    default_dynamic_qconfig, float_qparams_weight_only_qconfig
+
+from data import gen_data
+from evaluate import evaluate_model
+from utils import RelationBank
+from embed_cache import que_embed_cache
+from config import CONFIG as conf
+
+model_path = conf['model_path']
+batch_size = conf['batch_size']
+
+# a copy of the model for CPU inference: the weights of the LSTMs are int8
+# and the activations are quantized on the fly, the rows of the frozen word
+# embedding are uint8 with a float scale and offset per row
+def quantize_model(model):
+    model = copy.deepcopy(model).to('cpu')
+    return quantize_dynamic(model,
+                            {nn.LSTM: default_dynamic_qconfig,
+                             nn.Embedding: float_qparams_weight_only_qconfig},
+                            dtype=torch.qint8, inplace=True)
+
+# bytes of the serialized weights of the model
+def model_size(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
+
+# resident memory of this process in bytes
+def resident_memory():
+    with open('/proc/self/statm') as file_in:
+        return int(file_in.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+
+# accuracy, samples per second (best of repeats) and weight size of the
+# model. The question embedding cache is bypassed, so every repeat runs the
+# question encoder
+def measure(model, testing_data, all_relations, reverse_model=None,
+            repeats=3):
+    times = []
+    cache_size = que_embed_cache.max_size
+    que_embed_cache.max_size = 0
+    try:
+        for i in range(repeats):
+            start_time = time.time()
+            acc = evaluate_model(model, testing_data, batch_size,
+                                 all_relations, 'cpu', reverse_model)
+            times.append(time.time()-start_time)
+    finally:
+        que_embed_cache.max_size = cache_size
+    return acc, len(testing_data)/min(times), model_size(model)
+
+# run evaluate_model on the float32 model and on its quantized copy, on the
+# CPU, and report the accuracy delta, the throughput and the memory of both
+def compare_quantized(model, testing_data, all_relations, reverse_model=None,
+                      repeats=3):
+    model = model.to('cpu')
+    memory_before = resident_memory()
+    quantized_model = quantize_model(model)
+    memory_after = resident_memory()
+    fp32_acc, fp32_speed, fp32_size = measure(model, testing_data,
+                                              all_relations, reverse_model,
+                                              repeats)
+    int8_acc, int8_speed, int8_size = measure(quantized_model, testing_data,
+                                              all_relations, reverse_model,
+                                              repeats)
+    print('fp32: accuracy %.6f, %.1f samples/s, weights %.2f MB'
+          % (fp32_acc, fp32_speed, fp32_size/2.0**20))
+    print('int8: accuracy %.6f, %.1f samples/s, weights %.2f MB'
+          % (int8_acc, int8_speed, int8_size/2.0**20))
+    print('accuracy delta %+.6f, speedup %.2fx, weights %.2fx smaller, '
+          'quantized copy took %.2f MB resident'
+          % (int8_acc-fp32_acc, int8_speed/fp32_speed,
+             fp32_size/float(int8_size),
+             (memory_after-memory_before)/2.0**20))
+    return quantized_model, (fp32_acc, fp32_speed, fp32_size), \
+        (int8_acc, int8_speed, int8_size)
+
+# python quantize.py [MODEL_PATH]
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        model_path = sys.argv[1]
+    model = torch.load(model_path, map_location='cpu', weights_only=False)
+    training_data, testing_data, valid_data,\
+        all_relations, vocabulary,  embedding = gen_data()
+    all_relations = RelationBank(all_relations, 'cpu')
+    model.init_embedding(np.array(embedding))
+    compare_quantized(model, testing_data, all_relations)
@@ -0,0 +1,36 @@
+import numpy as np
+
+# a snapshot file holds a 24 byte header (magic, number of relations,
+# embedding size), the int64 relation ids and the float32 embedding matrix
+snapshot_magic = b'RELEMB01'
+header_dtype = np.dtype([('magic', 'S8'), ('num_rels', '<i8'), ('dim', '<i8')])
+
+# write the relation ids and their embeddings with a single write call
+def save_rel_embed_snapshot(file_name, rels, embeds):
+    rels = np.ascontiguousarray(rels, dtype='<i8')
+    embeds = np.ascontiguousarray(embeds, dtype='<f4')
+    header = np.array([(snapshot_magic, len(rels), embeds.shape[1])],
+                      dtype=header_dtype)
+    with open(file_name, 'wb') as file_out:
+        file_out.write(b''.join([header.tobytes(), rels.tobytes(),
+                                 embeds.tobytes()]))
+
+# memory-map the relation ids and the embedding matrix of a snapshot
+def load_rel_embed_snapshot(file_name):
+    header = np.fromfile(file_name, dtype=header_dtype, count=1)[0]
+    if header['magic'] != snapshot_magic:
+        raise ValueError('%s is not a relation embedding snapshot' % file_name)
+    num_rels = int(header['num_rels'])
+    dim = int(header['dim'])
+    if num_rels == 0:
+        return np.zeros(0, dtype='<i8'), np.zeros((0, dim), dtype='<f4')
+    rels = np.memmap(file_name, dtype='<i8', mode='r',
+                     offset=header_dtype.itemsize, shape=(num_rels,))
+    embeds = np.memmap(file_name, dtype='<f4', mode='r',
+                       offset=header_dtype.itemsize+rels.nbytes,
+                       shape=(num_rels, dim))
+    return rels, embeds
+
+# the snapshots of a sequence of tasks, eg. one file per task
+def load_rel_embed_series(file_names):
+    return [load_rel_embed_snapshot(file_name) for file_name in file_names]
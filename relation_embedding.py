@@ -1,9 +1,12 @@
 import numpy as np
-import wordninja
 from sklearn.decomposition import PCA
 #from matplotlib import pyplot
 from gensim.scripts.glove2word2vec import glove2word2vec
 from gensim.models import KeyedVectors
+from glove_store import load_glove_store
+from parallel_io import map_file_chunks
+from relation_names import RelationNames
+from relation_tokenizer import RelationTokenizer, save_segment_memo
 from config import CONFIG as conf
 
 sq_relation_name_file = conf['relation_file']
@@ -12,45 +15,36 @@ sq_valid_file = conf['valid_file']
 sq_test_file = conf['test_file']
 glove_input_file = conf['glove_file']
 
+# the distinct relation indexs of some lines, in order of first occurrence
+def parse_relations_index_lines(lines):
+    relation_pool = {}
+    for line in lines:
+        relation_pool[int(line.split("\t")[0])] = None
+    return list(relation_pool)
+
 # read the indexs of relations in a given file
 def read_relations_index(file_name):
-    relation_pool = []
-    with open(file_name) as in_file:
-        for line in in_file:
-            relation_number = int(line.split("\t")[0])
-            if relation_number not in relation_pool:
-                relation_pool.append(relation_number)
-    return relation_pool
+    relation_pool = {}
+    for chunk in map_file_chunks(parse_relations_index_lines, file_name):
+        relation_pool.update(dict.fromkeys(chunk))
+    return list(relation_pool)
 
 # extract the names of relations given their indexs, note that the index starts
 # from 1
 def read_relation_names(file_name, relation_index):
-    all_relations = []
-    with open(file_name) as in_file:
-        for line in in_file:
-            # remove "\n" for each line
-            all_relations.append(line.split("\n")[0])
-    relation_names = [all_relations[num-1] for num in relation_index]
+    all_relations = RelationNames(file_name)
+    relation_names = [all_relations[num] for num in relation_index]
     return relation_names
 
 # read the embeddings for a given vocabulary
 def read_glove_embeddings(glove_input_file):
-    glove_dict = {}
-    with open(glove_input_file) as in_file:
-        for line in in_file:
-            values = line.split()
-            word = values[0]
-            glove_dict[word] = np.asarray(values[1:], dtype='float32')
-    return glove_dict
+    return load_glove_store(glove_input_file)
+
+# no glove vocabulary, every word of the relation is split by wordninja
+relation_tokenizer = RelationTokenizer()
 
 def split_relation_into_words(relation):
-    word_list = []
-    # some relation will have fours parts, where the first part looks like
-    # "base". We only choose the last three parts
-    for word_seq in relation.split("/")[-3:]:
-        for word in word_seq.split("_"):
-            word_list += wordninja.split(word)
-    return word_list
+    return relation_tokenizer.split_relation(relation)
 
 # generate the vocabulary of these realtions
 def gen_vocabulary(relation_names):
@@ -96,6 +90,7 @@ def gen_relation_embedding():
     for relation in relation_names:
         relation_embeddings.append(get_embedding(relation,
                                                  glove_embeddings))
+    save_segment_memo()
     '''
     with open('relations.txt', 'w') as file_out:
         for item in relation_names:
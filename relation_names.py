@@ -0,0 +1,65 @@
+import os
+import mmap
+import operator
+import numpy as np
+from collections.abc import Sequence
+
+# the line offsets sit beside the relation file as <file>.offsets.npy
+def offsets_path(relation_file):
+    return relation_file + '.offsets.npy'
+
+# start offset of every line of the file, followed by the file size
+def build_line_offsets(relation_file):
+    size = os.path.getsize(relation_file)
+    if size == 0:
+        return np.zeros(1, dtype=np.int64)
+    with open(relation_file, 'rb') as file_in:
+        with mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            line_ends = np.flatnonzero(
+                np.frombuffer(buf, dtype=np.uint8) == ord('\n')) + 1
+    offsets = np.concatenate(([0], line_ends)).astype(np.int64)
+    # the last line may have no line break
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size)
+    return offsets
+
+def load_line_offsets(relation_file):
+    index_file = offsets_path(relation_file)
+    if not os.path.exists(index_file) or \
+            os.path.getmtime(index_file) < os.path.getmtime(relation_file):
+        offsets = build_line_offsets(relation_file)
+        np.save(index_file + '.tmp.npy', offsets)
+        os.replace(index_file + '.tmp.npy', index_file)
+    return np.load(index_file, mmap_mode='r')
+
+# the relation names of relation.2M.list, indexed like read_relations: index 0
+# is the '/fill/fill/fill' placeholder and index i is line i of the file. The
+# file is memory-mapped and a name is only decoded when it is asked for
+class RelationNames(Sequence):
+    def __init__(self, relation_file):
+        self.relation_file = relation_file
+        self.offsets = load_line_offsets(relation_file)
+        self.buf = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def name(self, index):
+        if index == 0:
+            return '/fill/fill/fill'
+        if self.buf is None:
+            with open(self.relation_file, 'rb') as file_in:
+                self.buf = mmap.mmap(file_in.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        line = self.buf[self.offsets[index-1]:self.offsets[index]]
+        return line.rstrip(b'\r\n').decode('utf8')
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.name(i) for i in range(*index.indices(len(self)))]
+        index = operator.index(index)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('relation index out of range')
+        return self.name(index)
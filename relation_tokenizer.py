@@ -0,0 +1,103 @@
+import os
+import re
+import pickle
+import wordninja
+from config import CONFIG as conf
+
+segment_file = conf['segment_cache_file']
+
+# word -> wordninja segmentation, shared by all tokenizers of the process and
+# persisted in segment_file between runs
+segment_memo = None
+num_new_segments = 0
+
+def load_segment_memo():
+    global segment_memo
+    if segment_memo is None:
+        segment_memo = {}
+        if os.path.exists(segment_file):
+            with open(segment_file, 'rb') as file_in:
+                segment_memo = pickle.load(file_in)
+    return segment_memo
+
+# write the memo back if wordninja was called for new words
+def save_segment_memo():
+    global num_new_segments
+    if segment_memo is None or num_new_segments == 0:
+        return
+    segment_dir = os.path.dirname(segment_file)
+    if len(segment_dir) > 0:
+        os.makedirs(segment_dir, exist_ok=True)
+    tmp_file = '%s.%d.tmp' % (segment_file, os.getpid())
+    with open(tmp_file, 'wb') as file_out:
+        pickle.dump(segment_memo, file_out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, segment_file)
+    num_new_segments = 0
+
+# memoized wordninja.split
+def segment_word(word):
+    global num_new_segments
+    memo = load_segment_memo()
+    segments = memo.get(word)
+    if segments is None:
+        segments = wordninja.split(word)
+        memo[word] = segments
+        num_new_segments += 1
+    return segments
+
+# split relations such as /people/person/place_of_birth into words. Words in
+# glove_vocabulary are kept as they are, other words are split by wordninja.
+# Without a vocabulary every word goes through wordninja. word_pattern is the
+# regex used to find the words of a relation part, by default the part is
+# split on '_'
+class RelationTokenizer(object):
+    def __init__(self, glove_vocabulary=None, word_pattern=None):
+        # membership test must be hashed, a list of 400k words is a linear scan
+        if glove_vocabulary is not None and \
+                not isinstance(glove_vocabulary, (set, frozenset, dict)):
+            glove_vocabulary = set(glove_vocabulary)
+        self.glove_vocabulary = glove_vocabulary
+        self.word_pattern = None
+        if word_pattern is not None:
+            self.word_pattern = re.compile(word_pattern)
+        # relation parts repeat a lot (people, person, ...), remember them
+        self.part_words = {}
+
+    def split_part(self, word_seq):
+        words = self.part_words.get(word_seq)
+        if words is not None:
+            return words
+        if self.word_pattern is None:
+            raw_words = word_seq.split('_')
+        else:
+            raw_words = self.word_pattern.findall(word_seq)
+        words = []
+        for word in raw_words:
+            if self.glove_vocabulary is not None and \
+                    word in self.glove_vocabulary:
+                words.append(word)
+            else:
+                words += segment_word(word)
+        self.part_words[word_seq] = words
+        return words
+
+    # with_names adds the concatenated parts after the words, eg.
+    # birth_place_of will be turned into [birth, place, of, birth_place_of]
+    def split_relation(self, relation, with_names=False):
+        word_list = []
+        relation_list = []
+        # some relation will have fours parts, where the first part looks like
+        # "base". We only choose the last three parts
+        for word_seq in relation.split("/")[-3:]:
+            new_word_list = self.split_part(word_seq)
+            word_list += new_word_list
+            relation_list.append('_'.join(new_word_list))
+        if with_names:
+            return word_list + relation_list
+        return word_list
+
+    def split_relations(self, relation_list, with_names=False):
+        cleaned_relations = [self.split_relation(relation, with_names)
+                             for relation in relation_list]
+        save_segment_memo()
+        return cleaned_relations
@@ -0,0 +1,202 @@
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from sklearn.cluster import KMeans
+
+from data import gen_data
+from evaluate import compute_rel_index
+from utils import RelationBank, ranking_sequence
+from sample_store import lengths2offsets
+from rel_embed_snapshot import save_rel_embed_snapshot, \
+    load_rel_embed_snapshot
+from config import CONFIG as conf
+
+model_path = conf['model_path']
+device = conf['device']
+batch_size = conf['batch_size']
+retrieval_block_size = conf['retrieval_block_size']
+retrieval_top_k = conf['retrieval_top_k']
+ivf_num_lists = conf['ivf_num_lists']
+ivf_num_probes = conf['ivf_num_probes']
+ivf_train_size = conf['ivf_train_size']
+rel_catalog_file = conf['rel_catalog_file']
+# relations encoded per call of compute_rel_index when building the catalog
+catalog_chunk_size = 100000
+
+# the k best scores of every row, best first, and their columns
+def top_k(scores, k):
+    k = min(k, scores.shape[1])
+    cols = np.argpartition(-scores, k-1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, cols, 1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(top_scores, order, 1), \
+        np.take_along_axis(cols, order, 1)
+
+# the normalized embedding of every relation of the bank but the
+# '/fill/fill/fill' placeholder, after the reverse model when one is given.
+# The catalog is written as a relation embedding snapshot when file_name is
+# given
+def build_catalog(model, all_relations, device, reverse_model=None,
+                  file_name=None):
+    rel_ids = np.arange(1, len(all_relations))
+    rel_embeds = None
+    with torch.no_grad():
+        for start in range(0, len(rel_ids), catalog_chunk_size):
+            chunk_ids = rel_ids[start:start+catalog_chunk_size]
+            chunk_embeds = compute_rel_index(model, chunk_ids, all_relations,
+                                             device, reverse_model)
+            chunk_embeds = chunk_embeds.cpu().numpy()
+            if rel_embeds is None:
+                rel_embeds = np.empty((len(rel_ids), chunk_embeds.shape[1]),
+                                      dtype=np.float32)
+            rel_embeds[start:start+len(chunk_ids)] = chunk_embeds
+    if file_name is not None:
+        save_rel_embed_snapshot(file_name, rel_ids, rel_embeds)
+    return rel_ids, rel_embeds
+
+# the normalized embeddings of the questions (lists of token ids), after the
+# reverse model when one is given
+def encode_questions(model, questions, device, reverse_model=None):
+    que_embeds = []
+    with torch.no_grad():
+        for i in range(0, len(questions), batch_size):
+            batch = [torch.tensor(question, dtype=torch.long).to(device)
+                     for question in questions[i:i+batch_size]]
+            ranked_questions, reverse_question_indexs = \
+                ranking_sequence(batch)
+            question_lengths = [len(question) for question in ranked_questions]
+            pad_questions = torch.nn.utils.rnn.pad_sequence(ranked_questions)
+            embeds = model.compute_que_embed(pad_questions, question_lengths,
+                                             reverse_question_indexs,
+                                             reverse_model)
+            que_embeds.append(F.normalize(embeds, dim=1).cpu().numpy())
+    return np.concatenate(que_embeds)
+
+# top-k search of normalized question embeddings over a catalog of normalized
+# relation embeddings (rel_embeds may be memory-mapped). search is exact: the
+# catalog is scored block by block with a matrix product and the running
+# top-k is merged with the top-k of each block, so only a (questions, block)
+# score matrix is in memory. After build_ivf, search_ivf only scores the
+# relations of the num_probes lists whose centroids are closest to the
+# question
+class RelationRetriever(object):
+    def __init__(self, rel_ids, rel_embeds, block_size=None):
+        if block_size is None:
+            block_size = retrieval_block_size
+        self.rel_ids = np.asarray(rel_ids)
+        self.rel_embeds = rel_embeds
+        self.block_size = block_size
+        self.centroids = None
+
+    def __len__(self):
+        return len(self.rel_ids)
+
+    def search(self, que_embeds, k=None):
+        if k is None:
+            k = retrieval_top_k
+        que_embeds = np.asarray(que_embeds, dtype=np.float32)
+        best_scores = np.zeros((len(que_embeds), 0), dtype=np.float32)
+        best_rows = np.zeros((len(que_embeds), 0), dtype=np.int64)
+        for start in range(0, len(self), self.block_size):
+            block = np.asarray(self.rel_embeds[start:start+self.block_size])
+            scores = np.concatenate([best_scores, que_embeds @ block.T], 1)
+            rows = np.concatenate([best_rows, np.broadcast_to(
+                np.arange(start, start+len(block)),
+                (len(que_embeds), len(block)))], 1)
+            best_scores, cols = top_k(scores, k)
+            best_rows = np.take_along_axis(rows, cols, 1)
+        return best_scores, self.rel_ids[best_rows]
+
+    # cluster the catalog into num_lists inverted lists. KMeans is fitted on
+    # at most train_size sampled relations, then every relation goes to the
+    # list of its closest centroid
+    def build_ivf(self, num_lists=None, train_size=None, random_state=0):
+        if num_lists is None:
+            num_lists = ivf_num_lists
+        if train_size is None:
+            train_size = ivf_train_size
+        num_lists = min(num_lists, len(self))
+        rng = np.random.RandomState(random_state)
+        train_rows = np.sort(rng.choice(len(self), min(train_size, len(self)),
+                                        replace=False))
+        kmeans = KMeans(n_clusters=num_lists, random_state=random_state).fit(
+            np.asarray(self.rel_embeds[train_rows]))
+        labels = np.concatenate([
+            kmeans.predict(np.asarray(self.rel_embeds[start:
+                                                      start+self.block_size]))
+            for start in range(0, len(self), self.block_size)])
+        self.centroids = kmeans.cluster_centers_.astype(np.float32)
+        # the rows of list i are list_rows[list_offsets[i]:list_offsets[i+1]]
+        self.list_rows = np.argsort(labels, kind='stable')
+        self.list_offsets = lengths2offsets(
+            np.bincount(labels, minlength=num_lists))
+
+    def search_ivf(self, que_embeds, k=None, num_probes=None):
+        if self.centroids is None:
+            raise ValueError('build_ivf must be called before search_ivf')
+        if k is None:
+            k = retrieval_top_k
+        if num_probes is None:
+            num_probes = ivf_num_probes
+        que_embeds = np.asarray(que_embeds, dtype=np.float32)
+        # the lists were assigned by L2 distance to the centroids, which are
+        # not unit norm, so they are probed by L2 distance too:
+        # -|q-c|^2/2 = q.c - |c|^2/2 + a constant of the question
+        _, probes = top_k(que_embeds @ self.centroids.T -
+                          0.5*(self.centroids**2).sum(1), num_probes)
+        best_scores = np.full((len(que_embeds), k), -np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(que_embeds), k), dtype=self.rel_ids.dtype)
+        for i, que_embed in enumerate(que_embeds):
+            rows = np.concatenate([
+                self.list_rows[self.list_offsets[j]:self.list_offsets[j+1]]
+                for j in probes[i]])
+            if len(rows) == 0:
+                continue
+            rows.sort()
+            scores, cols = top_k(
+                (np.asarray(self.rel_embeds[rows]) @ que_embed)[None], k)
+            best_scores[i, :scores.shape[1]] = scores[0]
+            best_ids[i, :scores.shape[1]] = self.rel_ids[rows[cols[0]]]
+        return best_scores, best_ids
+
+# recall@k of the IVF search against the exact search, and the latency per
+# question of both, for every number of probed lists
+def benchmark(retriever, que_embeds, k=None, probes_list=(1, 4, 16, 64)):
+    if k is None:
+        k = retrieval_top_k
+    start_time = time.time()
+    _, exact_ids = retriever.search(que_embeds, k)
+    exact_latency = (time.time()-start_time)/len(que_embeds)
+    print('exact: %.3f ms/question' % (exact_latency*1000))
+    results = []
+    for num_probes in probes_list:
+        start_time = time.time()
+        _, ivf_ids = retriever.search_ivf(que_embeds, k, num_probes)
+        latency = (time.time()-start_time)/len(que_embeds)
+        recall = np.mean([len(np.intersect1d(ivf_ids[i], exact_ids[i]))
+                          / float(exact_ids.shape[1])
+                          for i in range(len(que_embeds))])
+        print('ivf probes %d: recall@%d %.4f, %.3f ms/question'
+              % (num_probes, k, recall, latency*1000))
+        results.append((num_probes, recall, latency))
+    return exact_latency, results
+
+if __name__ == '__main__':
+    model = torch.load(model_path, map_location=device, weights_only=False)
+    training_data, testing_data, valid_data,\
+        all_relations, vocabulary,  embedding = gen_data()
+    all_relations = RelationBank(all_relations, device)
+    model.init_embedding(np.array(embedding))
+    rel_ids, rel_embeds = build_catalog(model, all_relations, device,
+                                        file_name=rel_catalog_file)
+    retriever = RelationRetriever(*load_rel_embed_snapshot(rel_catalog_file))
+    retriever.build_ivf()
+    que_embeds = encode_questions(model, [sample[2] for sample in
+                                          testing_data], device)
+    _, exact_ids = retriever.search(que_embeds)
+    gold_ids = testing_data.relations()
+    print('gold relation in exact top %d: %.4f'
+          % (exact_ids.shape[1], np.mean(np.any(exact_ids ==
+                                                gold_ids[:, None], 1))))
+    benchmark(retriever, que_embeds)
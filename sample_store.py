@@ -0,0 +1,145 @@
+import operator
+import numpy as np
+from collections.abc import Sequence
+
+# start offset of each list in a flat array, from the list lengths
+def lengths2offsets(lengths):
+    offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+# gather the values of the given rows of a CSR array into one flat array
+def gather_csr(offsets, values, rows):
+    starts = offsets[rows]
+    lengths = offsets[rows+1] - starts
+    view_offsets = lengths2offsets(lengths)
+    positions = np.arange(view_offsets[-1]) - \
+        np.repeat(view_offsets[:-1] - starts, lengths)
+    return values[positions], view_offsets
+
+# the token ids of all relations in one flat array, CSR style: relation i is
+# token_ids[offsets[i]:offsets[i+1]]. Indexing a relation returns a view on
+# the flat array, so callers that expect a list of token arrays still work
+class RelationTokens(Sequence):
+    def __init__(self, token_ids, offsets):
+        self.token_ids = token_ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, index):
+        index = operator.index(index)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('relation index out of range')
+        return self.token_ids[self.offsets[index]:self.offsets[index+1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+# training/testing/valid samples kept in flat arrays instead of a list of
+# [relation_ix, candidate_ixs, question]. The candidates and the question
+# tokens of all samples are stored CSR style: the values of sample i are
+# values[offsets[i]:offsets[i+1]]. A store is a view on a subset of the rows
+# (in the given order), so slicing, filtering and splitting by cluster share
+# the arrays instead of copying the samples. Indexing a single sample still
+# returns a [relation_ix, candidate_ixs, question] list, so the store can be
+# used wherever a list of samples is expected
+class SampleStore(Sequence):
+    def __init__(self, relation_ids, cand_offsets, cand_values,
+                 question_offsets, question_values, rows=None,
+                 source_rows=None):
+        self.relation_ids = relation_ids
+        self.cand_offsets = cand_offsets
+        self.cand_values = cand_values
+        self.question_offsets = question_offsets
+        self.question_values = question_values
+        if rows is None:
+            rows = np.arange(len(relation_ids))
+        self.rows = rows
+        # the row of each sample of the arrays in the store they were
+        # gathered from, None when the arrays are not gathered
+        self.source_rows = source_rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def sample(self, row):
+        return [int(self.relation_ids[row]),
+                self.cand_values[self.cand_offsets[row]:
+                                 self.cand_offsets[row+1]].tolist(),
+                self.question_values[self.question_offsets[row]:
+                                     self.question_offsets[row+1]]]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.view(self.rows[index])
+        return self.sample(self.rows[operator.index(index)])
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.sample(row)
+
+    # store sharing the arrays with this one, holding only the given rows
+    def view(self, rows):
+        return SampleStore(self.relation_ids, self.cand_offsets,
+                           self.cand_values, self.question_offsets,
+                           self.question_values, rows, self.source_rows)
+
+    def take(self, indexs):
+        return self.view(self.rows[np.asarray(indexs, dtype=np.int64)])
+
+    def filter(self, mask):
+        return self.view(self.rows[np.asarray(mask, dtype=bool)])
+
+    # one view per group, in the original order inside each group
+    def split(self, labels, num_groups):
+        labels = np.asarray(labels)
+        return [self.view(self.rows[labels == i]) for i in range(num_groups)]
+
+    def relations(self):
+        return self.relation_ids[self.rows]
+
+    def candidate_lengths(self):
+        return self.cand_offsets[self.rows+1] - self.cand_offsets[self.rows]
+
+    def question_lengths(self):
+        return self.question_offsets[self.rows+1] - \
+            self.question_offsets[self.rows]
+
+    # candidates of all samples of the view and their offsets
+    def candidates(self):
+        return gather_csr(self.cand_offsets, self.cand_values, self.rows)
+
+    # question tokens of all samples of the view and their offsets
+    def questions(self):
+        return gather_csr(self.question_offsets, self.question_values,
+                          self.rows)
+
+    # the row of every sample of the view in the store the samples were read
+    # into, which identifies a sample across views and filtered copies
+    def source_ids(self):
+        if self.source_rows is None:
+            return self.rows
+        return self.source_rows[self.rows]
+
+    # keep only the candidates in the given relations, and drop the samples
+    # left without any candidate. Only the rows of the view are gathered, into
+    # a compact store of their own
+    def filter_candidates(self, relations):
+        relations = np.asarray(list(relations), dtype=self.cand_values.dtype)
+        cands, cand_offsets = self.candidates()
+        keep = np.isin(cands, relations)
+        kept_before = lengths2offsets(keep)
+        kept_lengths = kept_before[cand_offsets[1:]] - \
+            kept_before[cand_offsets[:-1]]
+        kept = np.flatnonzero(kept_lengths > 0)
+        rows = self.rows[kept]
+        question_values, question_offsets = gather_csr(
+            self.question_offsets, self.question_values, rows)
+        return SampleStore(self.relation_ids[rows],
+                           lengths2offsets(kept_lengths[kept]), cands[keep],
+                           question_offsets, question_values,
+                           source_rows=self.source_ids()[kept])
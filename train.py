@@ -9,9 +9,11 @@ import time
 
 from data import gen_data, read_origin_relation
 from model import SimilarityModel
-from utils import process_testing_samples, process_samples, ranking_sequence,\
-    copy_grad_data, get_grad_params
+from utils import process_testing_samples, copy_grad_data, get_grad_params, \
+    RelationBank, pad_candidates, CollatedBatch, collate_samples, BatchCache
 from evaluate import evaluate_model
+from batch_sampler import get_batches, take_samples
+from prefetch import prefetch_map
 from config import CONFIG as conf
 from sklearn.cluster import KMeans
 from sklearn import preprocessing  # to normalise existing X
@@ -27,6 +29,9 @@ loss_margin = conf['loss_margin']
 num_constrain = conf['num_constrain']
 data_per_constrain = conf['data_per_constrain']
 num_cands = conf['num_cands']
+bucket_batches = conf['bucket_batches']
+batch_token_budget = conf['batch_token_budget']
+shuffle_buckets = conf['shuffle_buckets']
 random.seed(100)
 origin_relation_names = read_origin_relation()
 
@@ -261,51 +266,53 @@ def sample_constrains(rel_samples, relations_frequences, rel_embeds,
                 #cand_set, min(len(cand_set), num_cands)), sample[2]]
     return ret_samples
 
+# the samples of a training step, their collated batch and the collated
+# memory batch replayed before them (None when there is none to prepare).
+# Runs in the prefetch threads
+def prepare_step(training_data, batch, memory_batch, batch_cache,
+                 all_relations, device):
+    samples = take_samples(training_data, batch)
+    # shuffled buckets give new batches in every epoch
+    if shuffle_buckets:
+        train_batch = collate_samples(samples, all_relations, device)
+    else:
+        train_batch = batch_cache.get(training_data, batch)
+    if memory_batch is not None:
+        memory_batch = batch_cache.get(memory_batch)
+    return samples, train_batch, memory_batch
+
+# samples is a list of samples or a batch collated by collate_samples
 def feed_samples(model, samples, loss_function, all_relations, device,
                  reverse_model=None, memory_que_embed=[], memory_rel_embed=[]):
-    questions, relations, relation_set_lengths = process_samples(
-        samples, all_relations, device)
-    #print('got data')
-    ranked_questions, reverse_question_indexs = \
-        ranking_sequence(questions)
-    ranked_relations, reverse_relation_indexs =\
-        ranking_sequence(relations)
-    question_lengths = [len(question) for question in ranked_questions]
-    relation_lengths = [len(relation) for relation in ranked_relations]
-    #print(ranked_questions)
-    pad_questions = torch.nn.utils.rnn.pad_sequence(ranked_questions)
-    pad_relations = torch.nn.utils.rnn.pad_sequence(ranked_relations)
-    #print(pad_questions)
-    pad_questions = pad_questions.to(device)
-    pad_relations = pad_relations.to(device)
-    #print(pad_questions)
+    if isinstance(samples, CollatedBatch):
+        batch = samples
+    else:
+        batch = collate_samples(samples, all_relations, device)
+    relation_set_lengths = batch.relation_set_lengths
 
     model.zero_grad()
     if reverse_model is not None:
         reverse_model.zero_grad()
-    model.init_hidden(device, sum(relation_set_lengths))
-    all_scores, cur_que_embed, cur_rel_embed = model(pad_questions,
-                                                     pad_relations, device,
-                       reverse_question_indexs, reverse_relation_indexs,
-                       question_lengths, relation_lengths, reverse_model,
-                       ret_embeds=True)
+    all_scores, cur_que_embed, cur_rel_embed = model(batch.pad_questions,
+                                                     batch.pad_relations,
+                                                     device,
+                       batch.reverse_question_indexs,
+                       batch.reverse_relation_indexs,
+                       batch.question_lengths, batch.relation_lengths,
+                       reverse_model, ret_embeds=True,
+                       question_rows=batch.question_rows,
+                       relation_rows=batch.relation_rows)
     all_scores = all_scores.to('cpu')
-    pos_scores = []
-    neg_scores = []
-    pos_index = []
-    start_index = 0
-    for length in relation_set_lengths:
-        pos_index.append(start_index)
-        pos_scores.append(all_scores[start_index].expand(length-1))
-        neg_scores.append(all_scores[start_index+1:start_index+length])
-        start_index += length
-    pos_scores = torch.cat(pos_scores)
-    neg_scores = torch.cat(neg_scores)
+    # every positive score is paired with each negative of its sample
+    scores, mask = pad_candidates(all_scores, relation_set_lengths)
+    neg_mask = mask[:, 1:]
+    pos_scores = scores[:, :1].expand_as(neg_mask)[neg_mask]
+    neg_scores = scores[:, 1:][neg_mask]
+    pos_index = np.cumsum([0] + relation_set_lengths[:-1])
     reverse_model_criterion = nn.MSELoss()
 
     loss = loss_function(pos_scores, neg_scores,
-                         torch.ones(sum(relation_set_lengths)-
-                                    len(relation_set_lengths)))
+                         torch.ones(len(neg_scores)))
     #if reverse_model is not None and len(memory_que_embed) > 0 and False:
     #if False:
     alpha = 0.0
@@ -424,7 +431,10 @@ def train(training_data, valid_data, vocabulary, embedding_dim, hidden_dim,
           past_fisher=None, rel_samples=[], relation_frequences=[],
           rel_embeds=None, rel_ques_cand=None, rel_acc_diff=None,
           all_seen_rels=None, update_rel_embed=None, reverse_model=None,
-          memory_que_embed=[],memory_rel_embed=[], to_update_reverse=False):
+          memory_que_embed=[],memory_rel_embed=[], to_update_reverse=False,
+          batch_cache=None):
+    if batch_cache is None:
+        batch_cache = BatchCache(all_relations, device)
     if model is None:
         torch.manual_seed(100)
         model = SimilarityModel(embedding_dim, hidden_dim, len(vocabulary),
@@ -442,8 +452,19 @@ def train(training_data, valid_data, vocabulary, embedding_dim, hidden_dim,
     for epoch_i in range(epoch):
         #print('epoch', epoch_i)
         #training_data = training_data[0:100]
-        for i in range((len(training_data)-1)//batch_size+1):
-            samples = training_data[i*batch_size:(i+1)*batch_size]
+        batches = get_batches(training_data, batch_size, bucket_batches,
+                              batch_token_budget, shuffle_buckets)
+        # the memory batches replayed in this epoch are known in advance,
+        # unless sample_constrains draws them for every batch
+        memory_batches = [None]*len(batches)
+        if len(memory_data) > 0 and len(rel_samples) == 0:
+            memory_batches = [memory_data[(memory_index+i)%len(memory_data)]
+                              for i in range(len(batches))]
+        steps = [(training_data, batch, memory_batch, batch_cache,
+                  all_relations, device)
+                 for batch, memory_batch in zip(batches, memory_batches)]
+        for samples, train_batch, prepared_memory_batch in \
+                prefetch_map(prepare_step, steps):
             seed_rels = []
             for item in samples:
                 if item[0] not in seed_rels:
@@ -479,6 +500,8 @@ def train(training_data, valid_data, vocabulary, embedding_dim, hidden_dim,
                 for this_memory in memory_data:
                     all_seen_data+=this_memory
                 memory_batch = memory_data[memory_index]
+                if prepared_memory_batch is not None:
+                    memory_batch = prepared_memory_batch
                 #memory_batch = random.sample(all_seen_data,
                 #                             min(batch_size, len(all_seen_data)))
                 #print(memory_data)
@@ -490,7 +513,7 @@ def train(training_data, valid_data, vocabulary, embedding_dim, hidden_dim,
                 else:
                     optimizer.step()
                 memory_index = (memory_index+1)%len(memory_data)
-            scores, loss = feed_samples(model, samples, loss_function,
+            scores, loss = feed_samples(model, train_batch, loss_function,
                                         all_relations, device, reverse_model)
             #end_time = time.time()
             #print('forward time:', end_time - start_time)
@@ -548,7 +571,10 @@ def train_memory(training_data, valid_data, vocabulary, embedding_dim, hidden_di
           past_fisher=None, rel_samples=[], relation_frequences=[],
           rel_embeds=None, rel_ques_cand=None, rel_acc_diff=None,
           all_seen_rels=None, update_rel_embed=None, reverse_model=None,
-          memory_que_embed=[],memory_rel_embed=[], to_update_reverse=False):
+          memory_que_embed=[],memory_rel_embed=[], to_update_reverse=False,
+          batch_cache=None):
+    if batch_cache is None:
+        batch_cache = BatchCache(all_relations, device)
     if model is None:
         torch.manual_seed(100)
         model = SimilarityModel(embedding_dim, hidden_dim, len(vocabulary),
@@ -567,7 +593,10 @@ def train_memory(training_data, valid_data, vocabulary, embedding_dim, hidden_di
         #print('epoch', epoch_i)
         #training_data = training_data[0:100]
         #for i in range((len(training_data)-1)//batch_size+1):
-        for i, samples in enumerate(memory_data):
+        memory_batches = prefetch_map(batch_cache.get,
+                                      [(samples,) for samples in memory_data])
+        for i, (samples, memory_batch) in enumerate(zip(memory_data,
+                                                        memory_batches)):
             #samples = training_data[i*batch_size:(i+1)*batch_size]
             seed_rels = []
             for item in samples:
@@ -593,8 +622,9 @@ def train_memory(training_data, valid_data, vocabulary, embedding_dim, hidden_di
                     optimizer.step()
                 memory_index = (memory_index+1)%len(memory_data)
                 '''
-            scores, loss = feed_samples(model, samples, loss_function,
-                                        all_relations, device, reverse_model)
+            scores, loss = feed_samples(model, memory_batch,
+                                        loss_function, all_relations, device,
+                                        reverse_model)
                                         #memory_que_embed[i], memory_rel_embed[i])
             #end_time = time.time()
             #print('forward time:', end_time - start_time)
@@ -622,6 +652,7 @@ def train_memory(training_data, valid_data, vocabulary, embedding_dim, hidden_di
 if __name__ == '__main__':
     training_data, testing_data, valid_data, all_relations, vocabulary, \
         embedding=gen_data()
+    all_relations = RelationBank(all_relations, device)
     train(training_data, valid_data, vocabulary, embedding_dim, hidden_dim,
           device, batch_size, lr, model_path, embedding, all_relations,
           model=None, epoch=100)
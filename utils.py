@@ -1,15 +1,69 @@
-
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from collections import namedtuple
+from batch_sampler import take_samples
+from sample_store import RelationTokens
 from config import CONFIG as conf
 
-# process the data by adding questions
+# the token ids of all relations packed once into a padded matrix on the
+# device, together with the length of each relation. Batches gather their
+# relations from it by id instead of building one tensor per candidate
+class RelationBank(object):
+    def __init__(self, relation_list, device):
+        self.relation_list = relation_list
+        self.device = device
+        if isinstance(relation_list, RelationTokens):
+            lengths = relation_list.lengths()
+            token_ids = relation_list.token_ids
+        else:
+            lengths = np.fromiter(map(len, relation_list), dtype=np.int64,
+                                  count=len(relation_list))
+            token_ids = np.concatenate(relation_list)
+        tokens = np.zeros((len(relation_list), lengths.max()), dtype=np.int32)
+        tokens[np.arange(lengths.max()) < lengths[:, None]] = token_ids
+        self.tokens = torch.from_numpy(tokens).to(device)
+        self.lengths = torch.from_numpy(lengths).to(device)
+
+    def __len__(self):
+        return len(self.relation_list)
+
+    def __getitem__(self, index):
+        return self.relation_list[index]
+
+    # the padded (length x number) tokens of the given relations ranked by
+    # length as pack_padded_sequence expects, their lengths and the indexs
+    # that bring the ranked relations back to the given order
+    def gather(self, relation_ids):
+        relation_ids = torch.as_tensor(relation_ids, dtype=torch.long,
+                                       device=self.device)
+        ranked_lengths, indexs = self.lengths[relation_ids].sort(
+            descending=True)
+        ranked_indexs, inverse_indexs = indexs.sort()
+        relation_lengths = ranked_lengths.tolist()
+        pad_relations = self.tokens[relation_ids[indexs],
+                                    :relation_lengths[0]].long().t()
+        return pad_relations.contiguous(), relation_lengths, inverse_indexs
+
+    # like gather, but every distinct relation is gathered once. relation_rows
+    # gives the row of each given relation in the gathered batch
+    def gather_unique(self, relation_ids):
+        relation_ids = torch.as_tensor(relation_ids, dtype=torch.long,
+                                       device=self.device)
+        unique_ids, relation_rows = torch.unique(relation_ids,
+                                                 return_inverse=True)
+        pad_relations, relation_lengths, inverse_indexs = \
+            self.gather(unique_ids)
+        return pad_relations, relation_lengths, inverse_indexs, relation_rows
+
+# process the data. Every question is returned once, question_rows gives the
+# question of each candidate relation. The relations are returned as ids of
+# the relation bank
 def process_testing_samples(sample_list, all_relations, device):
     questions = []
-    relations = []
+    relation_ids = []
     gold_relation_indexs = []
     relation_set_lengths = []
     for sample in sample_list:
@@ -17,34 +71,113 @@ def process_testing_samples(sample_list, all_relations, device):
         #print(relations[sample[0]])
         #print(sample)
         gold_relation_indexs.append(sample[0])
-        neg_relations = [torch.tensor(all_relations[index],
-                                      dtype=torch.long).to(device)
-                         for index in sample[1]]
-        relation_set_lengths.append(len(neg_relations))
-        relations += neg_relations
-        #questions += [question for i in range(relation_set_lengths[-1])]
-        questions += [question] * relation_set_lengths[-1]
-    return gold_relation_indexs, questions, relations, relation_set_lengths
-
-# process the data by adding questions
+        relation_ids += sample[1]
+        relation_set_lengths.append(len(sample[1]))
+        questions.append(question)
+    return gold_relation_indexs, questions, \
+        torch.tensor(relation_ids, dtype=torch.long), relation_set_lengths
+
+# process the data. Every question is returned once, question_rows gives the
+# question of each candidate relation. The relations are returned as ids of
+# the relation bank, the positive relation first
 def process_samples(sample_list, all_relations, device):
     questions = []
-    relations = []
+    relation_ids = []
     relation_set_lengths = []
     for sample in sample_list:
         question = torch.tensor(sample[2], dtype=torch.long).to(device)
         #print(relations[sample[0]])
         #print(sample)
-        pos_relation = torch.tensor(all_relations[sample[0]],
-                                    dtype=torch.long).to(device)
-        neg_relations = [torch.tensor(all_relations[index],
-                                      dtype=torch.long).to(device)
-                         for index in sample[1]]
-        relation_set_lengths.append(len(neg_relations)+1)
-        relations += [pos_relation]+ neg_relations
-        #questions += [question for i in range(relation_set_lengths[-1])]
-        questions += [question] * relation_set_lengths[-1]
-    return questions, relations, relation_set_lengths
+        relation_ids.append(sample[0])
+        relation_ids += sample[1]
+        relation_set_lengths.append(len(sample[1])+1)
+        questions.append(question)
+    return questions, torch.tensor(relation_ids, dtype=torch.long), \
+        relation_set_lengths
+
+# the index of the question of every candidate relation, question i is
+# repeated relation_set_lengths[i] times
+def get_question_rows(relation_set_lengths, device):
+    return torch.repeat_interleave(
+        torch.arange(len(relation_set_lengths)),
+        torch.tensor(relation_set_lengths)).to(device)
+
+# the flat per-candidate values of a batch (eg. the scores or the relation
+# ids) as a (batch, max candidates) matrix, with fill_value after the last
+# candidate of each sample, and the mask of the real candidates. The padding
+# of scores should be -inf so it never wins a max or gets softmax mass
+def pad_candidates(values, relation_set_lengths, fill_value=float('-inf')):
+    lengths = torch.tensor(relation_set_lengths, device=values.device)
+    mask = torch.arange(int(lengths.max()), device=values.device) < \
+        lengths[:, None]
+    padded = values.new_full(mask.size(), fill_value)
+    return padded.masked_scatter(mask, values), mask
+
+# the device tensors feed_samples needs for a batch of training samples
+CollatedBatch = namedtuple('CollatedBatch', [
+    'pad_questions', 'question_lengths', 'reverse_question_indexs',
+    'question_rows', 'pad_relations', 'relation_lengths',
+    'reverse_relation_indexs', 'relation_rows', 'relation_set_lengths'])
+
+def collate_samples(samples, all_relations, device):
+    questions, relation_ids, relation_set_lengths = process_samples(
+        samples, all_relations, device)
+    ranked_questions, reverse_question_indexs = \
+        ranking_sequence(questions)
+    pad_relations, relation_lengths, reverse_relation_indexs, \
+        relation_rows = all_relations.gather_unique(relation_ids)
+    question_lengths = [len(question) for question in ranked_questions]
+    pad_questions = torch.nn.utils.rnn.pad_sequence(ranked_questions)
+    pad_questions = pad_questions.to(device)
+    question_rows = get_question_rows(relation_set_lengths, device)
+    return CollatedBatch(pad_questions, question_lengths,
+                         reverse_question_indexs, question_rows,
+                         pad_relations, relation_lengths,
+                         reverse_relation_indexs, relation_rows,
+                         relation_set_lengths)
+
+# collated batches of one task, so every epoch reuses the tensors of the
+# first one. A batch is keyed by the data it was taken from and the indexes
+# of its samples (None for the whole data). The data are kept with their
+# batches, so their ids can't be reused while cached. The samples must not
+# change after they are cached; start a new cache when they do. get can be
+# called from several threads: a batch collated twice at the same time is
+# kept once
+class BatchCache(object):
+    def __init__(self, all_relations, device):
+        self.all_relations = all_relations
+        self.device = device
+        self.batches = {}
+
+    def __len__(self):
+        return len(self.batches)
+
+    def get(self, data, indexs=None):
+        key = (id(data), None if indexs is None else tuple(indexs))
+        if key not in self.batches:
+            samples = data
+            if indexs is not None:
+                samples = take_samples(data, indexs)
+            batch = collate_samples(samples, self.all_relations, self.device)
+            self.batches.setdefault(key, (data, batch))
+        return self.batches[key][1]
+
+# the candidate scores of a batch from a ScriptableScorer (or its TorchScript
+# export). The encoders take the batches in any order, so the sort of
+# ranking_sequence and gather is folded into the rows of the candidates
+def scripted_scores(scorer, questions, relation_ids, relation_set_lengths,
+                    all_relations, device):
+    ranked_questions, reverse_question_indexs = ranking_sequence(questions)
+    question_lengths = torch.tensor([len(question)
+                                     for question in ranked_questions])
+    pad_questions = torch.nn.utils.rnn.pad_sequence(ranked_questions)
+    pad_relations, relation_lengths, reverse_relation_indexs, \
+        relation_rows = all_relations.gather_unique(relation_ids)
+    question_rows = get_question_rows(relation_set_lengths, device)
+    return scorer(pad_questions, question_lengths, pad_relations,
+                  torch.tensor(relation_lengths),
+                  reverse_question_indexs.to(device)[question_rows],
+                  reverse_relation_indexs[relation_rows])
 
 def ranking_sequence(sequence):
     word_lengths = torch.tensor([len(sentence) for sentence in sequence])
@@ -1,6 +1,6 @@
-import numpy as np
 from sklearn.decomposition import PCA
 from matplotlib import pyplot
+from bert_feature import read_embedding
 
 
 # visualize using PCA
@@ -29,14 +29,6 @@ def read_relation_name(file_name):
             ret_names.append(line[:-1])
     return ret_names
 
-def read_embedding(file_name):
-    ret_np = []
-    with open(file_name) as file_in:
-        for line in file_in:
-            ret_np.append(np.fromstring(line[1:-2], dtype=float, sep=','))
-    #print(ret_np)
-    return np.asarray(ret_np)
-
 if __name__ == "__main__":
     relation_embeddings = read_embedding('bert_feature.txt')
     relation_names = read_relation_name('question_relation.txt')